@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# adaptive_periods: simulate how often feeds that change at different
+# rates get fetched, with and without adaptiveperiods.
+# Copyright 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Usage: adaptive_periods.py [DAYS]"""
+
+import sys
+
+from synthetic import make_config
+
+from rawdoglib.rawdog import ArticleIndex, Feed, Rawdog
+
+# How often rawdog is run from cron, and the feed's configured period.
+RUN_INTERVAL = 30 * 60
+
+CHANGE_INTERVALS = [
+    ("hourly", 60 * 60),
+    ("daily", 24 * 60 * 60),
+    ("weekly", 7 * 24 * 60 * 60),
+]
+
+
+def make_response(num_changes, status):
+    """Return a feedparser-style result for a feed that has changed
+    num_changes times."""
+    if status == 304:
+        return {"rawdog_responses": [{"status": 304}], "headers": {}}
+    entries = []
+    for i in range(max(num_changes - 10, 0), num_changes):
+        entries.append({"title": "Article %d" % i, "id": "article-%d" % i,
+                        "link": "http://example.org/%d" % i})
+    return {
+        "rawdog_responses": [{"status": 200}],
+        "headers": {"etag": '"%d"' % num_changes},
+        "version": "rss20",
+        "feed": {"title": "Example"},
+        "entries": entries,
+    }
+
+
+def simulate(days, change_interval, adaptive):
+    """Return the number of times a feed that changes every
+    change_interval seconds gets fetched over days days."""
+    config = make_config(adaptiveperiods=adaptive)
+    rawdog = Rawdog()
+    feed = Feed("http://example.org/feed")
+    feed.period = RUN_INTERVAL
+    articles = {}
+    index = ArticleIndex()
+
+    fetches = 0
+    start = 1600000000
+    for now in range(start, start + days * 86400, RUN_INTERVAL):
+        if not feed.needs_update(now):
+            continue
+        fetches += 1
+        num_changes = 1 + (now - start) // change_interval
+        # The server supports conditional requests.
+        if feed.etag == '"%d"' % num_changes:
+            p = make_response(num_changes, 304)
+        else:
+            p = make_response(num_changes, 200)
+            feed.etag = p["headers"]["etag"]
+        feed.update(rawdog, now, config, articles, p, index)
+        feed.adapt_period(now, config, p)
+    return fetches
+
+
+def main(args):
+    days = int(args[0]) if len(args) > 0 else 28
+
+    print("Fetches over %d days, running every %d minutes" % (days, RUN_INTERVAL // 60))
+    print("%-10s %10s %10s" % ("feed", "fixed", "adaptive"))
+    for name, interval in CHANGE_INTERVALS:
+        print("%-10s %10d %10d" % (name, simulate(days, interval, False),
+                                   simulate(days, interval, True)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
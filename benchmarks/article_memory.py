@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# article_memory: measure the memory and pickled size of stored articles.
+# Copyright 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Usage: article_memory.py [NUM-FEEDS [ARTICLES-PER-FEED]]"""
+
+import gc
+import pickle
+import sys
+import tracemalloc
+
+from synthetic import make_parsed_rawdog, timed
+
+
+def main(args):
+    num_feeds = int(args[0]) if len(args) > 0 else 100
+    per_feed = int(args[1]) if len(args) > 1 else 50
+
+    rawdog = make_parsed_rawdog(num_feeds, per_feed)
+    data = pickle.dumps(rawdog, pickle.HIGHEST_PROTOCOL)
+    del rawdog
+    gc.collect()
+
+    tracemalloc.start()
+    load_time, rawdog = timed(pickle.loads, data)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print("State with %d feeds, %d articles" % (num_feeds, len(rawdog.articles)))
+    print("pickled size     %8d kB" % (len(data) // 1024))
+    print("memory once read %8d kB" % (memory // 1024))
+    print("bytes/article    %8d" % (memory // len(rawdog.articles)))
+    print("load time        %8.3f s" % load_time)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# parse_pool: compare parsing feeds in one process with parsing them in
+# a pool of processes.
+# Copyright 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Usage: parse_pool.py [NUM-FEEDS [ENTRIES-PER-FEED [NUM-PROCESSES]]]"""
+
+import os
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from synthetic import make_atom, make_config, timed
+
+from rawdoglib.rawdog import make_parse_pool, parse_in_pool, parse_response
+
+
+def main(args):
+    num_feeds = int(args[0]) if len(args) > 0 else 100
+    per_feed = int(args[1]) if len(args) > 1 else 50
+    num_processes = int(args[2]) if len(args) > 2 else (os.cpu_count() or 1)
+
+    rng = random.Random(42)
+    feeds = []
+    for f in range(num_feeds):
+        url = "http://example.org/%d/feed.atom" % f
+        feeds.append((url, make_atom(rng, f, per_feed)))
+    print("%d feeds, %d entries each, %d CPUs" % (num_feeds, per_feed, os.cpu_count() or 1))
+
+    def serial():
+        for url, content in feeds:
+            parse_response(url, 200, {}, content)
+
+    serial_time, _ = timed(serial)
+    print("%-24s %8.3f s" % ("in fetching thread", serial_time))
+
+    # Parse from several threads, as the fetchers would. Starting the
+    # pool is included in the time.
+    def pooled():
+        pool = make_parse_pool(make_config(parseprocesses=num_processes), num_feeds)
+        with ThreadPoolExecutor(num_processes * 2) as threads:
+            for url, content in feeds:
+                threads.submit(parse_in_pool, pool, url, url, 200, {}, content)
+        pool.shutdown()
+
+    pooled_time, _ = timed(pooled)
+    print("%-24s %8.3f s" % ("in %d processes" % num_processes, pooled_time))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
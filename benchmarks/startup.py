@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# startup: measure how long rawdog takes to start, using python -X importtime.
+# Copyright 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Usage: startup.py [REPEATS]"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+TOP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+RUN_RAWDOG = "import sys; from rawdoglib.rawdog import main; sys.exit(main(sys.argv[1:]))"
+
+
+def import_times(args):
+    """Run Python with -X importtime and the given arguments, returning
+    a list of (name, depth, cumulative microseconds) for each module
+    imported, and the wall-clock time taken."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = TOP_DIR
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime"] + args,
+                          env=env, cwd=TOP_DIR, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, text=True, check=True)
+    wall = time.perf_counter() - start
+
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        (_, cumulative, name) = line[12:].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), depth, int(cumulative)))
+    return imports, wall
+
+
+def best_of(repeats, args):
+    """As import_times, but return the run with the shortest wall-clock
+    time of several."""
+    return min((import_times(args) for i in range(repeats)), key=lambda r: r[1])
+
+
+def main(args):
+    repeats = int(args[0]) if len(args) > 0 else 5
+
+    imports, wall = best_of(repeats, ["-c", "import rawdoglib.rawdog"])
+    total = sum(us for name, depth, us in imports if depth == 0)
+    print("import rawdoglib.rawdog: %8.1f ms importing, %8.1f ms total"
+          % (total / 1000.0, wall * 1000.0))
+    for name, depth, us in imports:
+        if name == "rawdoglib.rawdog":
+            print("%-24s %8.1f ms" % ("  of which rawdoglib", us / 1000.0))
+
+    # A write-only run, as from cron, in a state dir with no feeds.
+    statedir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(statedir, "config"), "w") as f:
+            f.write("outputfile output.html\n")
+        run_args = ["-c", RUN_RAWDOG, "-d", statedir, "-w"]
+        import_times(run_args)
+        imports, wall = best_of(repeats, run_args)
+    finally:
+        shutil.rmtree(statedir)
+    total = sum(us for name, depth, us in imports if depth == 0)
+    print("rawdog -w:               %8.1f ms importing, %8.1f ms total"
+          % (total / 1000.0, wall * 1000.0))
+
+    print("Slowest top-level imports during rawdog -w:")
+    slowest = sorted((us, name) for name, depth, us in imports if depth == 0)[-8:]
+    for us, name in reversed(slowest):
+        print("  %-22s %8.1f ms" % (name, us / 1000.0))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# state_compression: compare save/load time and size of state files for
+# each compression codec.
+# Copyright 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Usage: state_compression.py [NUM-FEEDS [ARTICLES-PER-FEED]]"""
+
+import os
+import sys
+import tempfile
+
+from synthetic import make_config, make_rawdog, timed
+
+from rawdoglib.persister import Persister, available_codecs
+from rawdoglib.rawdog import Rawdog
+
+LEVELS = {
+    "none": [None],
+    "zlib": [1, 6, 9],
+    "lzma": [0, 3],
+    "zstd": [1, 3, 9],
+}
+
+
+def main(args):
+    num_feeds = int(args[0]) if len(args) > 0 else 200
+    per_feed = int(args[1]) if len(args) > 1 else 100
+
+    rawdog = make_rawdog(num_feeds, per_feed)
+    print("State with %d feeds, %d articles" % (num_feeds, len(rawdog.articles)))
+    print("%-6s %5s %10s %8s %8s" % ("codec", "level", "size (kB)", "save (s)", "load (s)"))
+
+    os.chdir(tempfile.mkdtemp())
+    for codec in available_codecs():
+        for level in LEVELS[codec]:
+            config = make_config(statecompression=(codec, level))
+            persister = Persister(config)
+
+            p = persister.get(Rawdog, "state")
+            p.object = rawdog
+            p.refcount = 1
+            rawdog.modified()
+            save_time, _ = timed(p.close)
+            size = os.stat("state").st_size
+
+            p = persister.get(Rawdog, "state")
+            load_time, loaded = timed(p.open)
+            assert len(loaded.articles) == len(rawdog.articles)
+            p.close()
+
+            print("%-6s %5s %10d %8.3f %8.3f"
+                  % (codec, "-" if level is None else level, size // 1024, save_time, load_time))
+            os.unlink("state")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,170 @@
+# synthetic: generate realistic-looking feeds and state for benchmarks.
+# Copyright 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from xml.sax.saxutils import escape
+
+from rawdoglib.rawdog import Article, ArticleIndex, Config, Feed, Rawdog, parse_response
+
+WORDS = ("the quick brown fox jumps over lazy dog feed article rawdog "
+         "aggregator python pickle state server update write template "
+         "sanitise html content summary link title author").split()
+
+
+def make_text(rng, num_words):
+    return " ".join(rng.choice(WORDS) for i in range(num_words))
+
+
+def make_html(rng, num_paragraphs):
+    paras = []
+    for i in range(num_paragraphs):
+        paras.append('<p>%s <a href="/%s">%s</a> <b>%s</b> %s</p>'
+                     % (make_text(rng, 30), rng.choice(WORDS), make_text(rng, 3),
+                        make_text(rng, 2), make_text(rng, 20)))
+    return "\n".join(paras)
+
+
+def make_entry(rng, feed_num, num):
+    """Return a dict like the entries feedparser produces for a typical
+    blog feed."""
+    link = "http://example.org/%d/%d.html" % (feed_num, num)
+    base = "http://example.org/%d/feed.atom" % feed_num
+    title = make_text(rng, 6)
+    summary = make_html(rng, 1)
+    content = make_html(rng, 6)
+    published = time.gmtime(1600000000 + num * 3600)
+    return {
+        "title": title,
+        "title_detail": {"type": "text/plain", "language": None,
+                         "base": base, "value": title},
+        "link": link,
+        "links": [{"rel": "alternate", "type": "text/html", "href": link}],
+        "id": link,
+        "guidislink": False,
+        "author": "Author %d" % feed_num,
+        "author_detail": {"name": "Author %d" % feed_num,
+                          "email": "author%d@example.org" % feed_num},
+        "authors": [{"name": "Author %d" % feed_num}],
+        "published": time.strftime("%a, %d %b %Y %H:%M:%S +0000", published),
+        "published_parsed": published,
+        "updated": time.strftime("%a, %d %b %Y %H:%M:%S +0000", published),
+        "updated_parsed": published,
+        "tags": [{"term": rng.choice(WORDS), "scheme": None, "label": None}],
+        "summary": summary,
+        "summary_detail": {"type": "text/html", "language": None,
+                           "base": base, "value": summary},
+        "content": [{"type": "text/html", "language": None,
+                     "base": base, "value": content}],
+    }
+
+
+def make_feed_info(feed_num):
+    url = "http://example.org/%d/" % feed_num
+    title = "Example feed %d" % feed_num
+    return {
+        "title": title,
+        "title_detail": {"type": "text/plain", "language": None,
+                         "base": url, "value": title},
+        "link": url,
+        "links": [{"rel": "alternate", "type": "text/html", "href": url}],
+        "subtitle": "All about feed %d" % feed_num,
+        "updated": "Sun, 13 Sep 2020 12:26:40 +0000",
+        "updated_parsed": time.gmtime(1600000000),
+    }
+
+
+def make_config(**settings):
+    config = Config(locking=False)
+    for key, value in settings.items():
+        config[key] = value
+    return config
+
+
+def make_rawdog(num_feeds, articles_per_feed, seed=42):
+    """Return a Rawdog containing num_feeds feeds with articles_per_feed
+    articles each, all in the single state."""
+    rng = random.Random(seed)
+    rawdog = Rawdog()
+    now = 1600000000
+    for f in range(num_feeds):
+        url = "http://example.org/%d/feed.atom" % f
+        feed = Feed(url)
+        feed.feed_info = make_feed_info(f)
+        feed.last_update = now
+        rawdog.feeds[url] = feed
+        for n in range(articles_per_feed):
+            article = Article(url, make_entry(rng, f, n), now - n * 600, n)
+            rawdog.articles[article.hash] = article
+    rawdog.article_index = ArticleIndex(rawdog.articles)
+    return rawdog
+
+
+def make_atom(rng, feed_num, num_entries):
+    """Return the text of an Atom feed with entries like make_entry's."""
+    feed_info = make_feed_info(feed_num)
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<feed xmlns="http://www.w3.org/2005/Atom">',
+             '<title>%s</title>' % escape(feed_info["title"]),
+             '<link href="%s"/>' % feed_info["link"],
+             '<subtitle>%s</subtitle>' % escape(feed_info["subtitle"]),
+             '<updated>2020-09-13T12:26:40Z</updated>',
+             '<id>%s</id>' % feed_info["link"]]
+    for num in range(num_entries):
+        entry = make_entry(rng, feed_num, num)
+        lines += ['<entry>',
+                  '<title>%s</title>' % escape(entry["title"]),
+                  '<link rel="alternate" type="text/html" href="%s"/>' % entry["link"],
+                  '<id>%s</id>' % entry["id"],
+                  '<author><name>%s</name><email>%s</email></author>'
+                  % (entry["author_detail"]["name"], entry["author_detail"]["email"]),
+                  '<published>%s</published>' % time.strftime("%Y-%m-%dT%H:%M:%SZ", entry["published_parsed"]),
+                  '<updated>%s</updated>' % time.strftime("%Y-%m-%dT%H:%M:%SZ", entry["updated_parsed"]),
+                  '<category term="%s"/>' % entry["tags"][0]["term"],
+                  '<summary type="html">%s</summary>' % escape(entry["summary"]),
+                  '<content type="html">%s</content>' % escape(entry["content"][0]["value"]),
+                  '</entry>']
+    lines.append('</feed>')
+    return "\n".join(lines).encode("utf-8")
+
+
+def make_parsed_rawdog(num_feeds, articles_per_feed, seed=42):
+    """As make_rawdog, but parse real Atom feeds with feedparser and add
+    them using Feed.update, so the articles are exactly as rawdog would
+    store them."""
+    rng = random.Random(seed)
+    config = make_config()
+    rawdog = Rawdog()
+    now = 1600000000
+    for f in range(num_feeds):
+        url = "http://example.org/%d/feed.atom" % f
+        feed = Feed(url)
+        rawdog.feeds[url] = feed
+        p = parse_response(url, 200, {}, make_atom(rng, f, articles_per_feed))
+        feed.update(rawdog, now, config, rawdog.articles, p, rawdog.article_index)
+    return rawdog
+
+
+def timed(func, *args):
+    """Call func, returning (seconds taken, result)."""
+    start = time.perf_counter()
+    result = func(*args)
+    return (time.perf_counter() - start, result)
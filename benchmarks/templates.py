@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# templates: compare compiled templates with the old fill_template.
+# Copyright 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Usage: templates.py [NUM-ITEMS]"""
+
+import random
+import sys
+from io import StringIO
+
+from synthetic import make_config, make_rawdog, timed
+
+from rawdoglib.rawdog import fill_template, template_re
+
+
+def old_fill_template(template, bits):
+    """fill_template as it was before templates were compiled."""
+
+    f = StringIO()
+    if_stack = []
+
+    def write(s):
+        if False not in if_stack:
+            f.write(s)
+
+    for part in template_re.split(template):
+        if part.startswith("__") and part.endswith("__"):
+            key = part[2:-2]
+            if key.startswith("if_"):
+                k = key[3:]
+                if_stack.append(k in bits and bits[k] != "")
+            elif key == "endif":
+                if if_stack:
+                    if_stack.pop()
+            elif key == "else":
+                if if_stack:
+                    if_stack.append(not if_stack.pop())
+            elif key in bits:
+                write(bits[key])
+        else:
+            write(part)
+    v = f.getvalue()
+    f.close()
+    return v
+
+
+def check_random_templates(count):
+    """Check that both implementations agree on random templates,
+    including badly-nested ones."""
+    rng = random.Random(42)
+    tokens = ["text", " ", "__a__", "__b__", "__c__", "__if_a__", "__if_b__",
+              "__if_c__", "__else__", "__endif__", "_", "__"]
+    for i in range(count):
+        template = "".join(rng.choice(tokens) for j in range(rng.randrange(20)))
+        bits = {}
+        for k in "ab":
+            bits[k] = rng.choice(["", "x", "__a__"])
+        assert fill_template(template, bits) == old_fill_template(template, bits), template
+
+
+def main(args):
+    num_items = int(args[0]) if len(args) > 0 else 5000
+
+    check_random_templates(20000)
+
+    config = make_config()
+    rawdog = make_rawdog(1, 1)
+    item_template = rawdog.get_template(config, "item")
+    page_template = rawdog.get_template(config, "page")
+
+    feed = list(rawdog.feeds.values())[0]
+    bits = rawdog.get_feed_bits(config, feed)
+    bits.update({"title": "Title", "title_no_link": "Title", "url": "http://example.org/",
+                 "guid": "", "hash": "01234567", "description": "<p>Description</p>",
+                 "author": "", "added": "Now", "date": ""})
+    page_bits = {"items": "<p>Items</p>" * 1000, "feeds": "", "version": "2.24",
+                 "num_items": "1000", "num_feeds": "10", "refresh": ""}
+
+    print("%-20s %10s %10s" % ("template", "old (s)", "new (s)"))
+    for name, template, b in [("item", item_template, bits), ("page", page_template, page_bits)]:
+        def run(func):
+            for i in range(num_items):
+                func(template, b)
+
+        old_time, _ = timed(run, old_fill_template)
+        new_time, _ = timed(run, fill_template)
+        print("%-20s %10.3f %10.3f" % ("%s x %d" % (name, num_items), old_time, new_time))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
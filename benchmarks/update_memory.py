@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# update_memory: measure the memory used while updating many feeds from
+# a local HTTP server.
+# Copyright 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Usage: update_memory.py [NUM-FEEDS [ENTRIES-PER-FEED [NUM-THREADS]]]"""
+
+import functools
+import http.server
+import os
+import random
+import sys
+import tempfile
+import threading
+import tracemalloc
+
+from synthetic import make_atom, make_config, timed
+
+import rawdoglib.rawdog
+from rawdoglib.persister import Persister
+from rawdoglib.rawdog import Rawdog
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def main(args):
+    num_feeds = int(args[0]) if len(args) > 0 else 100
+    per_feed = int(args[1]) if len(args) > 1 else 25
+    num_threads = int(args[2]) if len(args) > 2 else 4
+
+    os.chdir(tempfile.mkdtemp())
+    os.mkdir("pub")
+    rng = random.Random(42)
+    for f in range(num_feeds):
+        with open("pub/%d.atom" % f, "wb") as out:
+            out.write(make_atom(rng, f, per_feed))
+
+    handler = functools.partial(QuietHandler, directory="pub")
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:%d/" % server.server_address[1]
+
+    print("%d feeds, %d entries each, %d threads" % (num_feeds, per_feed, num_threads))
+    for splitstate in (False, True):
+        feeds = [(base + "%d.atom" % f, 0, {}) for f in range(num_feeds)]
+        config = make_config(splitstate=splitstate, numthreads=num_threads,
+                             feedslist=feeds)
+        rawdoglib.rawdog.persister = Persister(config)
+        rawdog = Rawdog()
+        rawdog.sync_from_config(config)
+
+        tracemalloc.start()
+        update_time, _ = timed(rawdog.update, config)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("splitstate %-5s peak %8d kB %8.3f s" % (splitstate, peak // 1024, update_time))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
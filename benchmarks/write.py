@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# write: time writing the output file for a large page.
+# Copyright 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Usage: write.py [NUM-FEEDS [ARTICLES-PER-FEED]]"""
+
+import os
+import sys
+import tempfile
+
+from synthetic import make_config, make_rawdog, timed
+
+import rawdoglib.rawdog
+from rawdoglib.persister import Persister
+
+
+def main(args):
+    num_feeds = int(args[0]) if len(args) > 0 else 200
+    per_feed = int(args[1]) if len(args) > 1 else 25
+
+    rawdog = make_rawdog(num_feeds, per_feed)
+    print("Page with %d feeds, %d articles" % (num_feeds, len(rawdog.articles)))
+
+    os.chdir(tempfile.mkdtemp())
+    for rendercache in (False, True):
+        config = make_config(maxarticles=0, rendercache=rendercache)
+        rawdoglib.rawdog.persister = Persister(config)
+        for run in ("cold", "warm"):
+            if run == "warm" and not rendercache:
+                continue
+            write_time, _ = timed(rawdog.write, config)
+            print("rendercache %-5s %-4s %8.3f s, %d kB"
+                  % (rendercache, run, write_time, os.stat("output.html").st_size // 1024))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,191 @@
+# asyncfetch: fetch feeds concurrently using asyncio and aiohttp
+# Copyright 2026 agent <agent@local>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This is kept separate from rawdog.py, and only imported when the
+# asyncio fetch backend is used, because importing aiohttp is slow.
+
+import asyncio
+import queue
+import threading
+import time
+import traceback
+
+import aiohttp
+
+from rawdoglib.rawdog import HostScheduler, fetch_error, parse_in_pool, parse_response, url_host
+
+# Older versions of aiohttp don't distinguish connect timeouts.
+ConnectionTimeoutError = getattr(aiohttp, "ConnectionTimeoutError", ())
+
+
+def host_unreachable(err):
+    """Return True if an aiohttp exception means that rawdog couldn't
+    connect to the host at all, as rawdog.host_unreachable does for
+    requests."""
+    if isinstance(err, (aiohttp.ClientSSLError, aiohttp.ClientProxyConnectionError)):
+        return False
+    return isinstance(err, (aiohttp.ClientConnectorError, ConnectionTimeoutError))
+
+
+class AsyncFeedFetcher:
+    """Class that will handle fetching a set of feeds concurrently,
+    using asyncio in a separate thread. It yields the same results as
+    FeedFetcher, and schedules fetches in the same way. If deadline is
+    given, any fetches that haven't finished by that time are
+    cancelled."""
+
+    def __init__(self, rawdog, feedlist, config, parse_pool=None, deadline=None):
+        self.rawdog = rawdog
+        self.config = config
+        self.parse_pool = parse_pool
+        self.deadline = deadline
+        self.scheduler = HostScheduler(feedlist, config["hostconnections"], config["hostdelay"])
+        self.results = queue.Queue()
+        self.slots = None
+        # This is set whenever a fetch finishes.
+        self.finished = None
+        self.skipped = []
+
+    async def fetch(self, session, job):
+        config = self.config
+        feed = self.rawdog.feeds[job]
+
+        config.log("Fetching feed: ", job)
+        try:
+            async with session.get(job, headers=feed.get_request_headers(config)) as response:
+                content = await response.read()
+        except asyncio.TimeoutError as err:
+            # A connect timeout, as with requests, means the host is down.
+            return {"rawdog_timeout": err, "rawdog_host_down": host_unreachable(err)}
+        except aiohttp.ClientError as err:
+            return {
+                "rawdog_exception": err,
+                "rawdog_traceback": traceback.format_exc(),
+                "rawdog_host_down": host_unreachable(err),
+            }
+
+        if self.parse_pool is not None:
+            # Wait for the parse in another thread, so that other
+            # fetches can carry on meanwhile.
+            return await asyncio.get_running_loop().run_in_executor(
+                None, parse_in_pool, self.parse_pool, config, job,
+                str(response.url), response.status, response.headers, content)
+        return parse_response(str(response.url), response.status, response.headers, content)
+
+    async def fetch_job(self, session, job):
+        try:
+            result = await self.fetch(session, job)
+        except Exception:
+            result = fetch_error()
+        self.scheduler.finished(job)
+        if result.get("rawdog_host_down") and self.config["maxbackoff"] > 0:
+            self.skipped += self.scheduler.drop_host(url_host(job))
+        self.finished.set()
+        self.results.put((job, result))
+
+    async def next_job(self):
+        """Return the next feed to fetch, waiting until the scheduler
+        allows it, or None if there are none left."""
+        while self.scheduler.remaining > 0:
+            now = time.time()
+            job = self.scheduler.next(now)
+            if job is not None:
+                return job
+            self.finished.clear()
+            try:
+                await asyncio.wait_for(self.finished.wait(), self.scheduler.wait_time(now))
+            except asyncio.TimeoutError:
+                pass
+        return None
+
+    async def start_fetches(self, session):
+        fetches = []
+        try:
+            while True:
+                # The slot is released by run once it's done with the
+                # result.
+                await self.slots.acquire()
+                job = await self.next_job()
+                if job is None:
+                    break
+                fetches.append(asyncio.ensure_future(self.fetch_job(session, job)))
+            await asyncio.gather(*fetches)
+        finally:
+            for fetch in fetches:
+                fetch.cancel()
+
+    async def fetch_all(self, max_connections):
+        config = self.config
+        self.slots = asyncio.Semaphore(max_connections)
+        self.finished = asyncio.Event()
+
+        # The connector queues requests once either limit is reached.
+        # (A limit_per_host of 0 means no limit, as for
+        # hostconnections.)
+        connector = aiohttp.TCPConnector(
+            limit=max_connections,
+            limit_per_host=config["hostconnections"])
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=config["timeout"],
+            sock_read=config["timeout"])
+        try:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                if self.deadline is None:
+                    await self.start_fetches(session)
+                else:
+                    await asyncio.wait_for(self.start_fetches(session), self.deadline - time.time())
+        except asyncio.TimeoutError:
+            config.log("Cancelled fetches still in progress at the deadline")
+        finally:
+            # Tell run that there are no more results.
+            self.results.put(None)
+
+    def run_loop(self, loop, task):
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            loop.run_until_complete(loop.shutdown_default_executor())
+
+    def run(self, max_connections):
+        """Fetch the feeds, yielding (url, result) for each feed as
+        soon as it has been fetched. No more than max_connections
+        results are kept waiting at once."""
+        max_connections = max(max_connections, 1)
+
+        self.config.log("Fetching ", self.scheduler.remaining, " feeds using ",
+                        max_connections, " connections")
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(self.fetch_all(max_connections))
+        thread = threading.Thread(target=self.run_loop, args=(loop, task))
+        thread.start()
+        try:
+            while True:
+                result = self.results.get()
+                if result is None:
+                    break
+                yield result
+                # Let another fetch start in place of this one.
+                loop.call_soon_threadsafe(self.slots.release)
+        finally:
+            if thread.is_alive():
+                loop.call_soon_threadsafe(task.cancel)
+            thread.join()
+            # This is only closed now, as slots may be released after
+            # the last fetch has finished.
+            loop.close()
+        self.config.log("Fetch complete")
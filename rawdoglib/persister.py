@@ -1,4 +1,4 @@
-# persister: persist Python objects safely to pickle files
+# persister: persist Python objects safely to pickle files or a database
 # Copyright 2003, 2004, 2005, 2013, 2014 Adam Sampson <ats@offog.org>
 #
 # This program is free software: you can redistribute it and/or modify
@@ -18,16 +18,123 @@
 import pickle
 import errno
 import fcntl
+import hashlib
 import os
 import sys
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# The codecs that can be used to compress state, and the magic numbers
+# at the start of the data they produce.
+ZLIB_MAGIC = b"\x78"
+LZMA_MAGIC = b"\xfd7zXZ\x00"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def available_codecs():
+    """Return the names of the compression codecs that can be used."""
+    codecs = ["none", "zlib"]
+    if lzma is not None:
+        codecs.append("lzma")
+    if zstandard is not None:
+        codecs.append("zstd")
+    return codecs
+
+
+def compress(data, codec, level=None):
+    """Compress pickled data using the named codec. If level is None,
+    use the codec's default compression level."""
+    if codec == "zlib":
+        if level is None:
+            level = -1
+        return zlib.compress(data, level)
+    elif codec == "lzma":
+        if level is None:
+            level = lzma.PRESET_DEFAULT
+        return lzma.compress(data, preset=level)
+    elif codec == "zstd":
+        if level is None:
+            level = 3
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    else:
+        return data
+
+
+def decompress(data):
+    """Decompress data produced by compress, working out which codec
+    was used from its first few bytes. Uncompressed pickles start with
+    a protocol opcode, so they can't be confused with any of these."""
+    if data.startswith(ZLIB_MAGIC):
+        return zlib.decompress(data)
+    elif data.startswith(LZMA_MAGIC):
+        if lzma is None:
+            raise ValueError("State is compressed with lzma, but the lzma module isn't available")
+        return lzma.decompress(data)
+    elif data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError("State is compressed with zstd, but the zstandard module isn't available")
+        return zstandard.ZstdDecompressor().decompress(data)
+    else:
+        return data
+
+
+def file_stamp(filename):
+    """Return a value that changes whenever a file is replaced."""
+    st = os.stat(filename)
+    return (st.st_size, st.st_mtime_ns)
+
+
+def load_summary(filename):
+    """Load the summary saved alongside a pickle file, returning None
+    if there isn't one or it's out of date."""
+    try:
+        with open(filename + ".rows", "rb") as f:
+            (stamp, rows) = pickle.load(f)
+        if stamp != file_stamp(filename):
+            return None
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+    return rows
 
 
 class Persistable:
     """An object which can be persisted."""
 
+    # Attributes holding dicts which a persister may store one item at
+    # a time, so that it only needs to save the items that have
+    # changed. Each is mapped to a tuple of item attributes that the
+    # persister should store alongside the item, so that they can be
+    # listed with list_rows without loading the items.
+    row_attributes = {}
+
+    # Attributes that are left out when saving the object, because the
+    # object will rebuild them in __setstate__.
+    derived_attributes = ()
+
+    # Row attributes that list_rows should be able to list. Persisters
+    # that don't store rows individually save a summary of these
+    # alongside the object.
+    summary_attributes = ()
+
     def __init__(self):
         self._modified = False
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for attr in self.derived_attributes:
+            state.pop(attr, None)
+        return state
+
     def modified(self, state=True):
         """Mark the object as having been modified (or not)."""
         self._modified = state
@@ -47,13 +154,15 @@ class Persisted:
         self.lock_file = None
         self.object = None
         self.refcount = 0
+        # Digest of the data the object was loaded from.
+        self.saved_digest = None
 
     def rename(self, new_filename):
         """Rename the persisted file. This works whether the file is
         currently open or not."""
 
         self.persister._rename(self.filename, new_filename)
-        for ext in ("", ".lock"):
+        for ext in ("", ".lock", ".rows"):
             try:
                 os.rename(self.filename + ext,
                           new_filename + ext)
@@ -122,18 +231,76 @@ class Persisted:
         if not self._get_lock(no_block):
             return None
 
+        self.object = self._load()
+        if self.object is None:
+            # Nothing saved yet.
+            # Create a new object.
+            self.object = self.klass()
+            self.object.modified()
+        else:
+            self.object.modified(False)
+
+    def _load(self):
+        """Load the object, returning None if it hasn't been saved."""
         try:
             f = open(self.filename, "rb")
         except IOError:
             # File can't be opened.
-            # Create a new object.
-            self.object = self.klass()
-            self.object.modified()
-            return
+            return None
 
-        self.object = pickle.load(f)
-        self.object.modified(False)
+        data = decompress(f.read())
         f.close()
+        self.saved_digest = hashlib.sha1(data).digest()
+        return pickle.loads(data)
+
+    def _save(self):
+        """Save the object, unless it's identical to what was loaded.
+        Return True if it was saved."""
+        data = pickle.dumps(self.object, pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.sha1(data).digest()
+        if digest == self.saved_digest:
+            self.persister.log("State file unchanged: ", self.filename)
+            return False
+        self._write_file(self.filename, self.persister.compress(data))
+        self.saved_digest = digest
+        self.persister._written(self.filename)
+        return True
+
+    def _write_file(self, filename, data):
+        newname = "%s.new-%d" % (filename, os.getpid())
+        newfile = open(newname, "wb")
+        newfile.write(data)
+        newfile.close()
+        os.rename(newname, filename)
+
+    def _update_summary(self, saved):
+        """Save the summary of the object's summary_attributes that
+        list_rows reads, if the object has just been saved or the
+        summary is missing or out of date."""
+        if not self.klass.summary_attributes:
+            return
+        if not saved and load_summary(self.filename) is not None:
+            return
+        if not os.path.exists(self.filename):
+            return
+
+        rows = {}
+        for attr in self.klass.summary_attributes:
+            columns = self.klass.row_attributes[attr]
+            rows[attr] = [(key,) + tuple(getattr(item, c, None) for c in columns)
+                          for key, item in getattr(self.object, attr).items()]
+        data = pickle.dumps((file_stamp(self.filename), rows), pickle.HIGHEST_PROTOCOL)
+        self._write_file(self.filename + ".rows", data)
+
+    def save(self):
+        """Save the object back to its file if it's been modified,
+        keeping it open."""
+        saved = False
+        if self.object.is_modified():
+            self.persister.log("Saving state file: ", self.filename)
+            saved = self._save()
+            self.object.modified(False)
+        self._update_summary(saved)
 
     def close(self):
         """Reduce the reference count of the persisted object, saving
@@ -144,13 +311,7 @@ class Persisted:
             # Still in use.
             return
 
-        if self.object.is_modified():
-            self.persister.log("Saving state file: ", self.filename)
-            newname = "%s.new-%d" % (self.filename, os.getpid())
-            newfile = open(newname, "wb")
-            pickle.dump(self.object, newfile, pickle.HIGHEST_PROTOCOL)
-            newfile.close()
-            os.rename(newname, self.filename)
+        self.save()
 
         if self.lock_file is not None:
             self.lock_file.close()
@@ -164,6 +325,15 @@ class Persister:
         self.files = {}
         self.log = config.log
         self.use_locking = config.locking
+        (self.codec, self.level) = config["statecompression"]
+        self.sync_state = config["syncstate"]
+        self.unsynced = []
+
+    def compress(self, data):
+        """Compress pickled data using the configured codec."""
+        return compress(data, self.codec, self.level)
+
+    persisted_class = Persisted
 
     def get(self, klass, filename):
         """Get a context manager for a persisted file.
@@ -173,10 +343,52 @@ class Persister:
         if filename in self.files:
             return self.files[filename]
 
-        p = Persisted(klass, filename, self)
+        p = self.persisted_class(klass, filename, self)
         self.files[filename] = p
         return p
 
+    def list_rows(self, klass, filename, attribute):
+        """Return a list of (key, values...) tuples for the items in
+        one of the row_attributes of a persisted object, where values
+        are the item attributes listed in row_attributes, without
+        loading the object. Return None if this isn't possible, in
+        which case the caller must load the object instead."""
+        if filename in self.files or attribute not in klass.summary_attributes:
+            return None
+        rows = load_summary(filename)
+        if rows is None:
+            return None
+        return rows[attribute]
+
+    def _written(self, filename):
+        if self.sync_state:
+            self.unsynced.append(filename)
+
+    def sync(self):
+        """Make sure that all the files saved so far are safely on
+        disk. Rather than syncing each file as it's saved, this syncs
+        them all at once, and then each directory containing them just
+        once to make the renames durable."""
+        dirs = set()
+        for filename in self.unsynced:
+            try:
+                fd = os.open(filename, os.O_RDONLY)
+            except OSError:
+                # It's been renamed or deleted since.
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            dirs.add(os.path.dirname(filename) or ".")
+        for dirname in dirs:
+            fd = os.open(dirname, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.unsynced = []
+
     def _rename(self, old_filename, new_filename):
         self.files[new_filename] = self.files[old_filename]
         del self.files[old_filename]
@@ -185,10 +397,191 @@ class Persister:
         del self.files[filename]
 
     def delete(self, filename):
-        """Delete a persisted file, along with its lock file,
-        if they exist."""
-        for ext in ("", ".lock"):
+        """Delete a persisted file, along with its lock file and
+        summary, if they exist."""
+        for ext in ("", ".lock", ".rows"):
             try:
                 os.unlink(filename + ext)
             except OSError:
                 pass
+
+
+class SQLitePersisted(Persisted):
+    """Context manager for a persistent object stored in an SQLite
+    database. Each item in the object's row_attributes is stored in its
+    own row, and only the rows that have changed are saved."""
+
+    def __init__(self, klass, filename, persister):
+        Persisted.__init__(self, klass, filename, persister)
+        self.imported = False
+        # Attribute -> {key: digest of the saved item}.
+        self.saved_rows = {}
+
+    def _open(self, no_block):
+        Persisted._open(self, no_block)
+        if self.imported:
+            # Make sure it gets saved into the database.
+            self.object.modified()
+
+    def _update_summary(self, saved):
+        # The rows can be listed from the database.
+        pass
+
+    def rename(self, new_filename):
+        # Like everything else, this is committed by
+        # SQLitePersister.sync.
+        db = self.persister.db
+        db.execute("UPDATE objects SET name = ? WHERE name = ?",
+                   (new_filename, self.filename))
+        for attr in self.klass.row_attributes:
+            self.persister._create_table(self.klass, attr)
+            db.execute('UPDATE "%s" SET name = ? WHERE name = ?' % attr,
+                       (new_filename, self.filename))
+        Persisted.rename(self, new_filename)
+
+    def _load(self):
+        db = self.persister.db
+        row = db.execute("SELECT data FROM objects WHERE name = ?",
+                         (self.filename,)).fetchone()
+        if row is None:
+            # Not in the database -- but there may be a pickle file
+            # saved by the pickle persister that we can import.
+            obj = Persisted._load(self)
+            if obj is not None:
+                self.persister.log("Importing state file into database: ", self.filename)
+                self.imported = True
+            return obj
+
+        data = decompress(row[0])
+        self.saved_digest = hashlib.sha1(data).digest()
+        state = pickle.loads(data)
+        self.saved_rows = {}
+        for attr in self.klass.row_attributes:
+            self.persister._create_table(self.klass, attr)
+            items = {}
+            digests = {}
+            for key, data in db.execute('SELECT key, data FROM "%s" WHERE name = ?' % attr,
+                                        (self.filename,)):
+                data = decompress(data)
+                items[key] = pickle.loads(data)
+                digests[key] = hashlib.sha1(data).digest()
+            state[attr] = items
+            self.saved_rows[attr] = digests
+
+        obj = self.klass.__new__(self.klass)
+        if hasattr(obj, "__setstate__"):
+            obj.__setstate__(state)
+        else:
+            obj.__dict__.update(state)
+        return obj
+
+    def _save(self):
+        db = self.persister.db
+        obj = self.object
+
+        state = obj.__getstate__()
+        for attr in self.klass.row_attributes:
+            state[attr] = {}
+
+        # This is committed by SQLitePersister.sync, so that all the
+        # objects saved during a run are written in one transaction.
+        data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.sha1(data).digest()
+        if digest != self.saved_digest:
+            db.execute("INSERT OR REPLACE INTO objects (name, data) VALUES (?, ?)",
+                       (self.filename, self.persister.compress(data)))
+            self.saved_digest = digest
+
+        for attr, columns in self.klass.row_attributes.items():
+            self.persister._create_table(self.klass, attr)
+            old_digests = self.saved_rows.get(attr, {})
+            new_digests = {}
+            insert = 'INSERT OR REPLACE INTO "%s" (name, key, %s data) VALUES (?, ?, %s ?)' \
+                % (attr, "".join('"%s", ' % c for c in columns), "?, " * len(columns))
+            for key, item in getattr(obj, attr).items():
+                data = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+                digest = hashlib.sha1(data).digest()
+                new_digests[key] = digest
+                if old_digests.get(key) != digest:
+                    values = [getattr(item, c, None) for c in columns]
+                    db.execute(insert, [self.filename, key] + values
+                               + [self.persister.compress(data)])
+            for key in old_digests:
+                if key not in new_digests:
+                    db.execute('DELETE FROM "%s" WHERE name = ? AND key = ?' % attr,
+                               (self.filename, key))
+            self.saved_rows[attr] = new_digests
+
+        if self.imported:
+            # Once it's in the database, remove the pickle file.
+            self.persister.imported.append(self.filename)
+            self.imported = False
+        return True
+
+
+class SQLitePersister(Persister):
+    """Manage a collection of persisted objects stored in an SQLite
+    database, rather than in individual files."""
+
+    persisted_class = SQLitePersisted
+
+    def __init__(self, config, db_filename):
+        # This is only imported here, so that rawdog doesn't have to
+        # load it when using the pickle backend.
+        import sqlite3
+
+        Persister.__init__(self, config)
+        self.db = sqlite3.connect(db_filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS objects "
+                        "(name TEXT PRIMARY KEY, data BLOB NOT NULL)")
+        self.db.commit()
+        self.tables = set()
+        self.imported = []
+
+    def _create_table(self, klass, attr):
+        """Make sure the table for one of klass's row_attributes
+        exists. This doesn't commit, as that would also commit any
+        objects that are halfway through being saved."""
+        if attr in self.tables:
+            return
+        columns = klass.row_attributes[attr]
+        self.db.execute('CREATE TABLE IF NOT EXISTS "%s" '
+                        '(name TEXT NOT NULL, key TEXT NOT NULL, %s data BLOB NOT NULL, '
+                        'PRIMARY KEY (name, key))'
+                        % (attr, "".join('"%s", ' % c for c in columns)))
+        for c in columns:
+            self.db.execute('CREATE INDEX IF NOT EXISTS "%s_%s" ON "%s" ("%s")'
+                            % (attr, c, attr, c))
+        self.tables.add(attr)
+
+    def sync(self):
+        """Commit everything saved so far. SQLite syncs the database
+        when committing, so there's no need for a separate sync."""
+        self.db.commit()
+        for filename in self.imported:
+            os.unlink(filename)
+            try:
+                os.unlink(filename + ".rows")
+            except OSError:
+                pass
+        self.imported = []
+
+    def list_rows(self, klass, filename, attribute):
+        if filename in self.files:
+            # It's open, so the database may be out of date.
+            return None
+        if self.db.execute("SELECT 1 FROM objects WHERE name = ?", (filename,)).fetchone() is None:
+            # It's not in the database -- it may still need importing.
+            return None
+        self._create_table(klass, attribute)
+        columns = klass.row_attributes[attribute]
+        return self.db.execute('SELECT key%s FROM "%s" WHERE name = ?'
+                               % ("".join(', "%s"' % c for c in columns), attribute),
+                               (filename,)).fetchall()
+
+    def delete(self, filename):
+        # This is committed by sync.
+        tables = self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        for (table,) in tables:
+            self.db.execute('DELETE FROM "%s" WHERE name = ?' % table, (filename,))
+        Persister.delete(self, filename)
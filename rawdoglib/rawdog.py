@@ -15,49 +15,64 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import calendar
+import collections
+import functools
 import getopt
 import hashlib
+import heapq
+import importlib.util
 import locale
 import os
+import queue
+import random
 import re
+import select
+import signal
 import socket
 import string
 import sys
 import threading
 import time
 import traceback
-import urllib.error
 import urllib.parse
-import urllib.parse
-import urllib.request
 from io import StringIO, BytesIO
 from html import escape as html_escape
 
-import feedparser
-import requests
-from feedparser.urls import resolve_relative_uris
-from feedparser.sanitizer import _HTMLSanitizer as HTMLSanitizer
-
-import rawdoglib.feedscanner
-from rawdoglib.persister import Persistable, Persister
+from rawdoglib.persister import Persistable, Persister, SQLitePersister, available_codecs
 from rawdoglib.plugins import Box, call_hook
 
-try:
-    import tidylib
-except:
-    tidylib = None
-
-try:
-    import mx.Tidy as mxtidy
-except:
-    mxtidy = None
-
+# Modules that take a long time to import -- feedparser, requests,
+# aiohttp, multiprocessing, email and the HTML tidying modules -- are
+# only imported by the code that needs them, so that actions such as
+# --write and --list that don't fetch or parse feeds can start quickly.
 
 
 VERSION = "2.24rc1"
 HTTP_AGENT = "rawdog/" + VERSION
 STATE_VERSION = 2
 
+# When maxbackoff is set, a feed that fails (or a host that can't be
+# reached) isn't tried again for about this long (or the feed's period,
+# if that's longer), doubling after each further failure.
+BACKOFF_BASE = 30 * 60
+
+# A string that can't appear in a filled-in template, since templates
+# and the HTML that goes into them are plain ASCII without NULs.
+ITEMS_MARKER = "\0items\0"
+
+# The parts of feedparser's feed and entry information that are kept
+# with each feed and article; the rest is thrown away to save memory.
+# Plugins that need anything else can add it to these lists, and users
+# can add to them with the keepfeedinfo and keepentryinfo options.
+FEED_INFO_KEYS = ["title", "title_detail", "link"]
+ENTRY_INFO_KEYS = ["title", "title_detail", "link", "id", "content",
+                   "summary_detail", "author", "author_detail",
+                   "updated_parsed", "published_parsed", "created_parsed"]
+
+# The config options that affect how an article is rendered into HTML.
+RENDER_CONFIG_KEYS = ("blocklevelhtml", "tidyhtml", "datetimeformat",
+                      "timeformat", "dayformat")
+
 # This is initialised in main().
 persister: Persister = None
 
@@ -101,6 +116,28 @@ def encode_references(s):
 block_level_re = re.compile(
     r'^\s*<(p|h1|h2|h3|h4|h5|h6|ul|ol|pre|dl|div|noscript|blockquote|form|hr|table|fieldset|address)[^a-z]', re.I)
 
+# Matches HTML that the sanitiser wouldn't change: text with no tags, and
+# no references other than those that html_escape and encode_references
+# produce (except for 128-159, which the sanitiser treats as cp1252).
+plain_html_re = re.compile(
+    r'(?:[^<&]|&(?:amp|lt|gt|quot|#x27);|&#(?!(?:12[89]|1[3-5][0-9]);)[0-9]+;)*\Z')
+
+
+@functools.lru_cache(maxsize=None)
+def get_tidy():
+    """Return a function that tidies HTML, given the HTML and a dict of
+    Tidy options, or None if no Tidy bindings are installed."""
+    try:
+        import tidylib
+        return lambda html, args: tidylib.tidy_document(html, args)[0]
+    except Exception:
+        pass
+    try:
+        import mx.Tidy as mxtidy
+        return lambda html, args: mxtidy.tidy(html, None, None, **args)[2]
+    except Exception:
+        return None
+
 
 def sanitise_html(html, baseurl, inline, config):
     """Attempt to turn arbitrary feed-provided HTML into something
@@ -121,10 +158,15 @@ def sanitise_html(html, baseurl, inline, config):
     # "<!doctype html!>"); just remove them all.
     html = re.sub(r'<![^>]*>', '', html)
 
-    html = resolve_relative_uris(html, baseurl, "UTF-8", type)
-    p = HTMLSanitizer("UTF-8", type)
-    p.feed(html)
-    html = p.output()
+    # Most titles and names are plain text, so this saves importing
+    # feedparser just to write the output.
+    if plain_html_re.match(html) is None:
+        from feedparser.urls import resolve_relative_uris
+        from feedparser.sanitizer import _HTMLSanitizer as HTMLSanitizer
+        html = resolve_relative_uris(html, baseurl, "UTF-8", type)
+        p = HTMLSanitizer("UTF-8", type)
+        p.feed(html)
+        html = p.output()
 
     if not inline and config["blocklevelhtml"]:
         # If we're after some block-level HTML and the HTML doesn't
@@ -156,10 +198,9 @@ def sanitise_html(html, baseurl, inline, config):
             # In tidy 5, wrap=0 means wrap to width 0.
             "wrap": 68,
         }
-        if tidylib is not None:
-            output = tidylib.tidy_document(html, args)[0]
-        elif mxtidy is not None:
-            output = mxtidy.tidy(html, None, None, **args)[2]
+        tidy = get_tidy()
+        if tidy is not None:
+            output = tidy(html, args)
         else:
             # No Tidy bindings installed -- do nothing.
             output = "<body>" + html + "</body>"
@@ -169,6 +210,162 @@ def sanitise_html(html, baseurl, inline, config):
     return html
 
 
+def plain_info(value):
+    """Convert part of a structure returned by feedparser into plain
+    dicts, lists and strings."""
+
+    if type(value) is str:
+        return value
+    elif isinstance(value, str):
+        # This is a subclass of str (e.g. BeautifulSoup's
+        # NavigableString, which is unpickleable in some versions of
+        # the library), so force it to be a real str object.
+        return str(value)
+    elif isinstance(value, dict):
+        return {k: (v if type(v) is str else plain_info(v))
+                for (k, v) in value.items()}
+    elif isinstance(value, list):
+        return [plain_info(v) for v in value]
+    else:
+        return value
+
+
+def trim_info(info, keys):
+    """Return a plain dict containing only the given keys from a
+    feedparser information dict."""
+
+    trimmed = {}
+    for k in keys:
+        # Looking up keys through FeedParserDict is slow, as it
+        # handles aliases for older key names, so only do that if
+        # the key isn't really there.
+        if dict.__contains__(info, k):
+            value = dict.__getitem__(info, k)
+        elif k in info:
+            value = info[k]
+        else:
+            continue
+        if type(value) is not str:
+            value = plain_info(value)
+        trimmed[k] = value
+    return trimmed
+
+
+def feed_info_keys(config):
+    """Return the keys of feedparser's feed information to keep."""
+    return FEED_INFO_KEYS + config["keepfeedinfo"]
+
+
+def entry_info_keys(config):
+    """Return the keys of feedparser's entry information to keep."""
+    return ENTRY_INFO_KEYS + config["keepentryinfo"]
+
+
+def saved_slots(obj):
+    """Return the names of the slots of an object with __slots__ that
+    its __getstate__ saves."""
+    return [name for name in obj.__slots__ if name != "__dict__"]
+
+
+def get_slots_state(obj):
+    """Return the state to save for an object with __slots__: a tuple
+    of its slot values in order, or, if plugins have given it other
+    attributes (which go in its __dict__), a tuple of that tuple and a
+    dict of the other attributes."""
+    values = tuple(getattr(obj, name) for name in saved_slots(obj))
+    if obj.__dict__:
+        return (values, dict(obj.__dict__))
+    return values
+
+
+def restore_slots(obj, state, defaults):
+    """Restore an object with __slots__ from the state saved by
+    get_slots_state, or from the __dict__ saved by older versions of
+    rawdog (in which case slots that weren't saved get their values
+    from defaults)."""
+    names = saved_slots(obj)
+    if isinstance(state, dict):
+        for name in names:
+            if name in state:
+                setattr(obj, name, state[name])
+            else:
+                setattr(obj, name, defaults[name])
+    else:
+        if len(state) == 2 and isinstance(state[0], tuple):
+            (state, attributes) = state
+            obj.__dict__.update(attributes)
+        for name, value in zip(names, state):
+            setattr(obj, name, value)
+        # Slots added since the state was saved come at the end.
+        for name in names[len(state):]:
+            setattr(obj, name, defaults[name])
+
+
+def url_host(url):
+    """Return the host (and port) part of a URL."""
+    return urllib.parse.urlsplit(url).netloc
+
+
+def backoff_delay(base, failures, limit):
+    """Return how long to wait before trying something again after it
+    has failed the given number of times in a row: twice as long after
+    each failure, up to limit, with some randomness added so that things
+    that failed together don't all get tried again together."""
+    delay = min(base * 2 ** (min(failures, 32) - 1), limit)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def parse_http_date(value):
+    """Parse an HTTP date into a time in seconds since the epoch, or
+    return None if it can't be parsed."""
+    import email.utils
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def get_freshness(headers, now):
+    """Return how long, in seconds, an HTTP response with the given
+    (lowercased) headers says it can be cached for, or 0 if it doesn't
+    say."""
+    for directive in headers.get("cache-control", "").split(","):
+        directive = directive.strip().lower()
+        if directive in ("no-cache", "no-store"):
+            return 0
+        if directive.startswith("max-age="):
+            try:
+                return max(int(directive[8:]), 0)
+            except ValueError:
+                return 0
+
+    expires = parse_http_date(headers.get("expires"))
+    if expires is None:
+        return 0
+    # Measure from the server's clock if possible.
+    date = parse_http_date(headers.get("date"))
+    if date is None:
+        date = now
+    return max(expires - date, 0)
+
+
+def get_retry_after(headers, now):
+    """Return the number of seconds an HTTP response with the given
+    (lowercased) headers asks us to wait before trying again, or None if
+    it doesn't say."""
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        pass
+    when = parse_http_date(value)
+    if when is None:
+        return None
+    return max(when - now, 0)
+
+
 def select_detail(details):
     """Pick the preferred type of detail from a list of details. (If the
     argument isn't a list, treat it as a list of one.)"""
@@ -259,39 +456,81 @@ def string_to_html(s, config):
 
 template_re = re.compile(r'(__[^_].*?__)')
 
+# Instructions in a compiled template.
+TEMPLATE_TEXT = 0
+TEMPLATE_BIT = 1
+TEMPLATE_IF = 2
 
-def fill_template(template, bits):
-    """Expand a template, replacing __x__ with bits["x"], and only
-    including sections bracketed by __if_x__ .. [__else__ ..]
-    __endif__ if bits["x"] is not "". If not bits.has_key("x"),
-    __x__ expands to ""."""
-
-    f = StringIO()
-    if_stack = []
 
-    def write(s):
-        if False not in if_stack:
-            f.write(s)
+def compile_template(template):
+    """Compile a template into a list of instructions for
+    run_template. Each instruction is a tuple: (TEMPLATE_TEXT, text),
+    (TEMPLATE_BIT, key), or (TEMPLATE_IF, key, sections) for an
+    __if_x__ block, where sections is a list of instruction lists split
+    at each __else__; the even-numbered sections are included if
+    bits["x"] is not "", and the odd-numbered ones if it is."""
 
+    code = []
+    ifs = []
+    current = code
     for part in template_re.split(template):
         if part.startswith("__") and part.endswith("__"):
             key = part[2:-2]
             if key.startswith("if_"):
-                k = key[3:]
-                if_stack.append(k in bits and bits[k] != "")
+                inst = (TEMPLATE_IF, key[3:], [[]])
+                current.append(inst)
+                ifs.append(inst)
+                current = inst[2][-1]
             elif key == "endif":
-                if if_stack:
-                    if_stack.pop()
+                if ifs:
+                    ifs.pop()
+                    current = ifs[-1][2][-1] if ifs else code
             elif key == "else":
-                if if_stack:
-                    if_stack.append(not if_stack.pop())
-            elif key in bits:
-                write(bits[key])
+                if ifs:
+                    ifs[-1][2].append([])
+                    current = ifs[-1][2][-1]
+            else:
+                current.append((TEMPLATE_BIT, key))
+        elif part != "":
+            current.append((TEMPLATE_TEXT, part))
+    return code
+
+
+def run_template(code, bits, out):
+    """Run a compiled template, appending the strings it produces to
+    the list out."""
+    for inst in code:
+        op = inst[0]
+        if op == TEMPLATE_TEXT:
+            out.append(inst[1])
+        elif op == TEMPLATE_BIT:
+            if inst[1] in bits:
+                out.append(bits[inst[1]])
         else:
-            write(part)
-    v = f.getvalue()
-    f.close()
-    return v
+            k = inst[1]
+            cond = (k in bits and bits[k] != "")
+            for i, section in enumerate(inst[2]):
+                if (i % 2 == 0) == cond:
+                    run_template(section, bits, out)
+
+
+compiled_templates = {}
+
+
+def fill_template(template, bits):
+    """Expand a template, replacing __x__ with bits["x"], and only
+    including sections bracketed by __if_x__ .. [__else__ ..]
+    __endif__ if bits["x"] is not "". If not bits.has_key("x"),
+    __x__ expands to "". Templates are compiled the first time they're
+    used, and the compiled version is kept for next time."""
+
+    code = compiled_templates.get(template)
+    if code is None:
+        code = compile_template(template)
+        compiled_templates[template] = code
+    out = []
+    run_template(code, bits, out)
+    return "".join(out)
 
 
 file_cache = {}
@@ -320,54 +559,95 @@ def short_hash(s: str):
     return hashlib.sha1(s.encode()).hexdigest()[-8:]
 
 
-def ensure_unicode(value, encoding):
-    """Convert a structure returned by feedparser into an equivalent where
-    all strings are represented as fully-decoded unicode objects."""
-
-    if isinstance(value, str):
-        return value
-    elif isinstance(value, str) and type(value) is not str:
-        # This is a subclass of unicode (e.g.  BeautifulSoup's
-        # NavigableString, which is unpickleable in some versions of
-        # the library), so force it to be a real unicode object.
-        return str(value)
-    elif isinstance(value, dict):
-        d = {}
-        for (k, v) in list(value.items()):
-            d[k] = ensure_unicode(v, encoding)
-        return d
-    elif isinstance(value, list):
-        return [ensure_unicode(v, encoding) for v in value]
-    else:
-        return value
-
+def parse_response(url, status, headers, content):
+    """Parse the body of an HTTP response for a feed, returning the
+    feedparser result with the response log added to it."""
+    import feedparser
+    try:
+        result = feedparser.parse(
+            BytesIO(content),
+            # Turn off content-cleaning, as we need the original content
+            # for hashing and we'll do this ourselves afterwards.
+            sanitize_html=False,
+            resolve_relative_uris=False,
+        )
+    except Exception as e:
+        result = {
+            "rawdog_exception": e,
+            "rawdog_traceback": traceback.format_exc(),
+        }
+    result["rawdog_responses"] = [
+        {
+            "url": url,
+            "status": status,
+        }
+    ]
+
+    # Provide the response headers in the same way feedparser would if
+    # it had fetched the feed itself.
+    result["headers"] = dict((k.lower(), v) for (k, v) in headers.items())
+    return result
+
+
+# The parts of the feedparser result that Feed.update uses.
+PARSED_KEYS = ("feed", "entries", "version", "headers", "rawdog_responses",
+               "rawdog_exception", "rawdog_traceback")
+
+
+def parse_response_for_feed(feed_url, entry_keys, feed_keys, url, status, headers, content):
+    """As parse_response, but for running in a worker process: do as
+    much of the work of adding the feed's articles as possible here, and
+    return only the parts of the result that Feed.update needs, as plain
+    types that are quick to send back. The entries are trimmed to the
+    given keys, and "rawdog_hashes" gives each entry's article hash."""
+    result = parse_response(url, status, headers, content)
+    p = dict((k, result[k]) for k in PARSED_KEYS if k in result)
+    if "rawdog_exception" in p:
+        # The exception may not be picklable.
+        p["rawdog_exception"] = str(p["rawdog_exception"])
+    if "feed" in p:
+        p["feed"] = trim_info(p["feed"], feed_keys)
+    if "entries" in p:
+        articles = [Article(feed_url, entry_info, 0, 0, entry_keys)
+                    for entry_info in p["entries"]]
+        p["entries"] = [article.entry_info for article in articles]
+        p["rawdog_hashes"] = [article.hash for article in articles]
+    return p
+
+
+def make_parse_pool(config, num_feeds):
+    """Return a ProcessPoolExecutor for parsing feeds, or None if feeds
+    should be parsed in the process that fetched them."""
+    num_processes = min(config["parseprocesses"], num_feeds)
+    if num_processes < 1:
+        return None
 
-# FIXME: port this to requests
-class ResponseLogProcessor(urllib.request.BaseHandler):
-    """urllib2 handler that maintains a log of HTTP responses."""
+    import concurrent.futures
+    import multiprocessing
 
-    # Run after anything that's mangling headers (usually 500 or less), but
-    # before HTTPErrorProcessor (1000).
-    handler_order = 900
+    # Forking a process that has fetcher threads running isn't safe,
+    # so start the workers from a fresh process where possible.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["rawdoglib.rawdog", "feedparser"])
+    else:
+        context = multiprocessing.get_context("spawn")
+    config.log("Parsing feeds using ", num_processes, " processes")
+    return concurrent.futures.ProcessPoolExecutor(num_processes, mp_context=context)
 
-    def __init__(self):
-        self.log = []
 
-    def http_response(self, req, response):
-        entry = {
-            "url": req.get_full_url(),
-            "status": response.getcode(),
+def parse_in_pool(pool, config, feed_url, url, status, headers, content):
+    """Parse a response for the feed at feed_url in a parsing pool,
+    returning the result in the form that Feed.update expects."""
+    try:
+        return pool.submit(parse_response_for_feed, feed_url,
+                           entry_info_keys(config), feed_info_keys(config),
+                           url, status, dict(headers.items()), content).result()
+    except Exception as err:
+        return {
+            "rawdog_exception": err,
+            "rawdog_traceback": traceback.format_exc()
         }
-        location = response.info().get("Location")
-        if location is not None:
-            entry["location"] = location
-        self.log.append(entry)
-        return response
-
-    https_response = http_response
-
-    def get_log(self):
-        return self.log
 
 
 non_alphanumeric_re = re.compile(r'<[^>]*>|\&[^\;]*\;|[^a-z0-9]')
@@ -376,6 +656,14 @@ non_alphanumeric_re = re.compile(r'<[^>]*>|\&[^\;]*\;|[^a-z0-9]')
 class Feed:
     """An RSS feed."""
 
+    __slots__ = ("url", "period", "args", "etag", "modified", "last_update",
+                 "feed_info", "article_summary", "change_history",
+                 "effective_period", "not_before", "failures",
+                 "backoff_until", "__dict__")
+
+    # The number of recent changes to remember in change_history.
+    history_length = 8
+
     def __init__(self, url):
         self.url = url
         self.period = 30 * 60
@@ -384,34 +672,142 @@ class Feed:
         self.modified = None
         self.last_update = 0
         self.feed_info = {}
+        # (number of articles, newest added time, newest feed date or
+        # added time) for the feed's articles in split state, or None
+        # if it isn't known.
+        self.article_summary = None
+        # The times of the most recent updates that found new or
+        # changed articles, oldest first.
+        self.change_history = ()
+        # The update period worked out by adapt_period, or None if
+        # the configured period should be used.
+        self.effective_period = None
+        # The server has asked us not to fetch the feed again before
+        # this time.
+        self.not_before = 0
+        # The number of updates in a row that have failed, and the
+        # time before which we shouldn't try again because of that.
+        self.failures = 0
+        self.backoff_until = 0
+
+    def __getstate__(self):
+        return get_slots_state(self)
+
+    def __setstate__(self, state):
+        restore_slots(self, state, {
+            "article_summary": None,
+            "change_history": (),
+            "effective_period": None,
+            "not_before": 0,
+            "failures": 0,
+            "backoff_until": 0,
+        })
+        if isinstance(state, dict):
+            self.feed_info = trim_info(self.feed_info, FEED_INFO_KEYS)
+
+    def get_period(self):
+        """Return the time between updates of this feed."""
+        if self.effective_period is None:
+            return self.period
+        return self.effective_period
 
     def needs_update(self, now):
         """Return True if it's time to update this feed, or False if
         its update period has not yet elapsed."""
-        return (now - self.last_update) >= self.period
+        if now < max(self.not_before, self.backoff_until):
+            return False
+        return (now - self.last_update) >= self.get_period()
+
+    def record_failure(self, now, config):
+        """Note that updating this feed has failed, and if maxbackoff is
+        set, don't try again for a while."""
+        self.failures += 1
+        if config["maxbackoff"] > 0:
+            base = max(self.period, BACKOFF_BASE)
+            self.backoff_until = now + backoff_delay(base, self.failures, config["maxbackoff"])
+        else:
+            self.backoff_until = 0
+
+    def record_success(self):
+        """Note that updating this feed has worked."""
+        self.failures = 0
+        self.backoff_until = 0
+
+    def get_overdue(self, now):
+        """Return how long ago this feed should have been updated."""
+        return now - self.last_update - self.get_period()
+
+    def adapt_period(self, now, config, p):
+        """Work out how often this feed should be updated from now on,
+        given the result p of updating it, if adaptiveperiods is
+        enabled."""
+        if not config["adaptiveperiods"]:
+            self.effective_period = None
+            self.not_before = 0
+            return
+
+        # Never update more often than the configured period says,
+        # and never less often than maxperiod.
+        period = self.period
+        max_period = max(config["maxperiod"], period)
+
+        # Poll at about twice the rate the feed has been changing at
+        # recently, and back off further while it's quiet.
+        history = self.change_history
+        if len(history) >= 2:
+            period = max(period, (history[-1] - history[0]) / (len(history) - 1) / 2)
+        if len(history) >= 1:
+            period = max(period, (now - history[-1]) / 4)
+
+        # There's no point fetching it again before the server says
+        # it will have changed.
+        headers = p.get("headers", {})
+        period = max(period, get_freshness(headers, now))
+
+        self.effective_period = int(min(period, max_period))
+
+        retry_after = get_retry_after(headers, now)
+        if retry_after is None:
+            self.not_before = 0
+        else:
+            self.not_before = now + min(retry_after, max_period)
 
     def get_state_filename(self):
         return "feeds/%s.state" % (short_hash(self.url),)
 
-    def fetch(self, rawdog, config):
-        """Fetch the current set of articles from the feed."""
-
-        handlers = []
-
-        logger = ResponseLogProcessor()
-        handlers.append(logger)
-
+    def allows_delta(self, config):
+        """Return True if it's OK to ask for RFC 3229 deltas of this
+        feed."""
+        # If RFC 3229 and "A-IM: feed" is used, then there's no way to
+        # tell when an article has been removed. So if we only want to
+        # keep articles that are still being published by the feed, we
+        # have to turn it off.
+        return self.get_keepmin(config) != 0 and not config["currentonly"]
+
+    def get_request_headers(self, config):
+        """Return the HTTP request headers to use when fetching this
+        feed."""
         request_headers = {"user-agent": HTTP_AGENT}
-        if self.get_keepmin(config) == 0 or config["currentonly"]:
-            # If RFC 3229 and "A-IM: feed" is used, then there's
-            # no way to tell when an article has been removed.
-            # So if we only want to keep articles that are still
-            # being published by the feed, we have to turn it off.
-            # FIXME: set "A-IM: identity" header here
+        if self.allows_delta(config):
+            # Ask for only the entries that have changed since the
+            # version identified by our ETag (RFC 3229).
+            request_headers["a-im"] = "feed"
+        else:
             request_headers["a-im"] = "identity"
         if self.etag:
             request_headers["if-none-match"] = self.etag
-        # FIXME support if-modified-since / self.modified
+        if self.modified:
+            request_headers["if-modified-since"] = self.modified
+        return request_headers
+
+    def fetch(self, rawdog, config, session=None, parse_pool=None):
+        """Fetch the current set of articles from the feed. If session
+        is given, it is the requests.Session to fetch with, so that
+        connections can be reused between feeds. If parse_pool is
+        given, the response is parsed in one of its processes."""
+        import requests
+
+        request_headers = self.get_request_headers(config)
 
         url = self.url
         # Turn plain filenames into file: URLs. (feedparser will open
@@ -421,46 +817,46 @@ class Feed:
             # um wtf? FIXME
             raise RuntimeError(f"No protocol specified in URL: {url}")
 
+        if session is None:
+            # The requests module has the same interface as a
+            # Session, but doesn't keep connections open.
+            session = requests
+
         try:
-            req = requests.get(url, headers=request_headers)
+            req = session.get(url, headers=request_headers, timeout=config["timeout"])
+        except requests.exceptions.ConnectTimeout as err:
+            return {"rawdog_timeout": err, "rawdog_host_down": True}
         except requests.exceptions.Timeout as err:
             return {"rawdog_timeout": err}
+        except requests.exceptions.ConnectionError as err:
+            result = fetch_error()
+            if host_unreachable(err):
+                result["rawdog_host_down"] = True
+            return result
         except requests.exceptions.RequestException as err:
             return {
                 "rawdog_exception": err,
                 "rawdog_traceback": traceback.format_exc()
             }
 
-        try:
-            result = feedparser.parse(
-                BytesIO(req.content),
-                # Turn off content-cleaning, as we need the original content
-                # for hashing and we'll do this ourselves afterwards.
-                sanitize_html=False,
-                resolve_relative_uris=False,
-            )
-        except Exception as e:
-            result = {
-                "rawdog_exception": e,
-                "rawdog_traceback": traceback.format_exc(),
-            }
-        result["rawdog_responses"] = [
-            {
-                "url": req.url,
-                "status": req.status_code,
-            }
-        ]
-        return result
+        if parse_pool is not None:
+            return parse_in_pool(parse_pool, config, self.url, req.url,
+                                 req.status_code, req.headers, req.content)
+        return parse_response(req.url, req.status_code, req.headers, req.content)
 
-    def update(self, rawdog, now, config, articles, p) -> bool:
-        """Add new articles from a feed to the collection.
-        Returns True if any articles were read, False otherwise."""
+    def update(self, rawdog, now, config, articles, p, index=None):
+        """Add new articles from a feed to the collection. index is
+        the ArticleIndex for articles, which will be kept up to date;
+        if it isn't given, one will be built.
+        Returns a tuple (read, changed): read is True if any articles
+        were read, and changed is True if the collection was
+        modified."""
 
         # Note that feedparser might have thrown an exception --
         # so until we print the error message and return, we
         # can't assume that p contains any particular field.
 
-        responses = p.get("rawdog_responses")
+        responses = p.get("rawdog_responses", [])
         if len(responses) > 0:
             last_status = responses[-1]["status"]
         elif len(p.get("feed", [])) != 0:
@@ -481,7 +877,8 @@ class Feed:
 
         if "rawdog_timeout" in p:
             if config["ignoretimeouts"]:
-                return False
+                self.record_failure(now, config)
+                return (False, False)
             else:
                 errors.append("Timeout while reading feed.")
                 errors.append("")
@@ -490,14 +887,20 @@ class Feed:
             errors.append("Error fetching or parsing feed:")
             errors.append(str(p["rawdog_exception"]))
             if config["showtracebacks"] and "rawdog_traceback" in p:
-                from traceback import format_tb
-                errors.append("".join(format_tb(p["rawdog_traceback"])))
+                # This is already formatted, as the traceback object
+                # can't be kept once the exception has been handled.
+                errors.append(p["rawdog_traceback"])
             errors.append("")
             fatal = True
         elif last_status == 304:
             # The feed hasn't changed. Return False to indicate
-            # that we shouldn't do expiry.
-            return False
+            # that we shouldn't do expiry. The server may have
+            # sent new validators, though.
+            headers = p.get("headers", {})
+            self.etag = headers.get("etag", self.etag)
+            self.modified = headers.get("last-modified", self.modified)
+            self.record_success()
+            return (False, False)
         elif last_status in [403, 410]:
             # The feed is disallowed or gone. The feed should be
             # unsubscribed.
@@ -505,7 +908,7 @@ class Feed:
             errors.append("You should remove it from your config file.")
             errors.append("")
             fatal = True
-        elif last_status / 100 != 2:
+        elif last_status // 100 != 2:
             # Some sort of client or server error. The feed may
             # need unsubscribing.
             errors.append("The feed returned an error.")
@@ -527,58 +930,99 @@ class Feed:
             for line in errors:
                 config.warn(line)
             if fatal:
-                return False
+                self.record_failure(now, config)
+                return (False, False)
+        self.record_success()
 
         # From here, we can assume that we've got a complete feedparser
         # response.
 
-        p = ensure_unicode(p, p.get("encoding") or "UTF-8")
+        # Only the parts of p that are kept are converted to plain
+        # types (by trim_info, as the feed and articles are created).
+
+        # Keep the validators from the response so that next time we
+        # can make a conditional request.
+        headers = p.get("headers", {})
+        self.etag = headers.get("etag")
+        self.modified = headers.get("last-modified")
 
         # No entries means the feed hasn't changed, but for some reason
         # we didn't get a 304 response. Handle it the same way.
         if len(p["entries"]) == 0:
-            return False
+            return (False, False)
 
-        self.etag = p.get("etag")
-        self.modified = p.get("modified")
-
-        self.feed_info = p["feed"]
+        self.feed_info = trim_info(p["feed"], feed_info_keys(config))
         feed = self.url
 
-        article_ids = {}
+        if index is None:
+            index = ArticleIndex(articles)
+
         if config["useids"]:
             # Find IDs for existing articles.
-            for (hash, a) in list(articles.items()):
-                id = a.entry_info.get("id")
-                if a.feed == feed and id is not None:
-                    article_ids[id] = a
+            article_ids = index.feed_ids(feed)
+        else:
+            article_ids = {}
+
+        # If the feed was parsed in a worker process, the article
+        # hashes have already been worked out.
+        hashes = p.get("rawdog_hashes")
 
+        changed = False
+        new_content = False
         seen_articles = set()
         sequence = 0
+        entry_keys = entry_info_keys(config)
         for entry_info in p["entries"]:
-            article = Article(feed, entry_info, now, sequence)
+            if hashes is None:
+                article = Article(feed, entry_info, now, sequence, entry_keys)
+            else:
+                article = Article(feed, entry_info, now, sequence, entry_keys,
+                                  hash=hashes[sequence])
             seen_articles.add(article.hash)
             sequence += 1
 
             id = entry_info.get("id")
             if id in article_ids:
-                existing_article = article_ids[id]
+                existing_article = articles[article_ids[id]]
             elif article.hash in articles:
                 existing_article = articles[article.hash]
             else:
                 existing_article = None
 
             if existing_article is not None:
-                existing_article.update_from(article, now)
+                # The ID may change, so reindex the article.
+                revision = existing_article.revision
+                if existing_article.update_from(article, now, config):
+                    index.remove(existing_article)
+                    index.add(existing_article)
+                    changed = True
+                    if existing_article.revision != revision:
+                        new_content = True
             else:
                 articles[article.hash] = article
-
-        if config["currentonly"]:
-            for (hash, a) in list(articles.items()):
-                if a.feed == feed and hash not in seen_articles:
+                index.add(article)
+                changed = True
+                new_content = True
+
+        if last_status == 226:
+            # A 226 response is a delta containing only the new and
+            # changed entries (RFC 3229), so the articles that aren't
+            # in it are still in the feed.
+            for hash in index.feed_hashes(feed):
+                if hash not in seen_articles and articles[hash].mark_seen(now, config):
+                    index.seen(articles[hash])
+                    changed = True
+        elif config["currentonly"]:
+            for hash in list(index.feed_hashes(feed)):
+                if hash not in seen_articles:
+                    index.remove(articles[hash])
                     del articles[hash]
+                    changed = True
 
-        return True
+        if new_content and config["adaptiveperiods"]:
+            self.change_history = (tuple(self.change_history) + (now,))[-self.history_length:]
+
+        return (True, changed)
 
     def get_html_name(self, config):
         if "title_detail" in self.feed_info:
@@ -608,14 +1052,42 @@ class Feed:
     def get_keepmin(self, config):
         return self.args.get("keepmin", config["keepmin"])
 
+    def summarise_articles(self, articles, index):
+        """Update article_summary from the feed's articles, so that
+        Rawdog.write can tell whether it needs to look at them without
+        loading them."""
+        newest_added = newest_date = float("-inf")
+        hashes = index.feed_hashes(self.url)
+        for key in hashes:
+            article = articles[key]
+            newest_added = max(newest_added, article.added)
+            newest_date = max(newest_date, article.date or article.added)
+        self.article_summary = (len(hashes), newest_added, newest_date)
+
+    def get_newest_sort_date(self, config):
+        """Return the newest sort date of the feed's articles, or None if
+        it isn't known."""
+        if self.article_summary is None:
+            return None
+        if config["sortbyfeeddate"]:
+            return self.article_summary[2]
+        else:
+            return self.article_summary[1]
+
 
 class Article:
     """An article retrieved from an RSS feed."""
 
-    def __init__(self, feed, entry_info, now, sequence):
+    __slots__ = ("feed", "entry_info", "sequence", "revision", "date",
+                 "hash", "last_seen", "added", "__dict__")
+
+    def __init__(self, feed, entry_info, now, sequence,
+                 entry_keys=ENTRY_INFO_KEYS, hash=None):
         self.feed = feed
-        self.entry_info = entry_info
+        self.entry_info = trim_info(entry_info, entry_keys)
         self.sequence = sequence
+        # This is incremented whenever the article's contents change.
+        self.revision = 0
 
         self.date = None
         parsed = entry_info.get("updated_parsed")
@@ -629,11 +1101,21 @@ class Article:
             except OverflowError:
                 pass
 
-        self.hash = self.compute_initial_hash()
+        if hash is None:
+            hash = self.compute_initial_hash()
+        self.hash = hash
 
         self.last_seen = now
         self.added = now
 
+    def __getstate__(self):
+        return get_slots_state(self)
+
+    def __setstate__(self, state):
+        restore_slots(self, state, {"revision": 0})
+        if isinstance(state, dict):
+            self.entry_info = trim_info(self.entry_info, ENTRY_INFO_KEYS)
+
     def compute_initial_hash(self):
         """Compute an initial unique hash for an article.
         The generated hash must be unique amongst all articles in the
@@ -659,16 +1141,34 @@ class Article:
 
         return h.hexdigest()
 
-    def update_from(self, new_article, now):
+    def update_from(self, new_article, now, config):
         """Update this article's contents from a newer article that's
-        been identified to be the same."""
-        self.entry_info = new_article.entry_info
-        self.sequence = new_article.sequence
-        self.date = new_article.date
-        self.last_seen = now
+        been identified to be the same. Return True if anything that
+        needs saving has changed."""
+        if (self.entry_info != new_article.entry_info
+                or self.sequence != new_article.sequence
+                or self.date != new_article.date):
+            self.entry_info = new_article.entry_info
+            self.sequence = new_article.sequence
+            self.date = new_article.date
+            self.revision += 1
+            self.last_seen = now
+            return True
+        return self.mark_seen(now, config)
+
+    def mark_seen(self, now, config):
+        """Note that this article is still in its feed. Return True if
+        anything that needs saving has changed."""
+        # With lastseenslack, an unchanged article's last-seen time is
+        # only refreshed once it's that far out of date, so that it
+        # doesn't need saving on every update.
+        if (now - self.last_seen) > config["lastseenslack"]:
+            self.last_seen = now
+            return True
+        return False
 
     def can_expire(self, now, config):
-        return (now - self.last_seen) > config["expireage"]
+        return self.last_seen < expire_before(now, config)
 
     def get_sort_date(self, config):
         if config["sortbyfeeddate"]:
@@ -677,6 +1177,108 @@ class Article:
             return self.added
 
 
+def expire_before(now, config):
+    """Return the time before which an article must have last been seen
+    for it to be expired."""
+    return now - config["expireage"] - config["lastseenslack"]
+
+
+class ArticleIndex:
+    """An index of a collection of articles by feed, so that the
+    articles from one feed can be found without looking through the
+    whole collection."""
+
+    def __init__(self, articles={}):
+        # Feed URL -> set of article hashes.
+        self.hashes = {}
+        # Feed URL -> {entry ID: article hash}.
+        self.ids = {}
+        # Feed URL -> {article hash: last-seen time}.
+        self.last_seen = {}
+        # Feed URL -> heap of (last-seen time, article hash). This isn't
+        # updated when articles are removed or seen again, so it may
+        # contain entries that are out of date; they're thrown away
+        # when they reach the top.
+        self.last_seen_heaps = {}
+
+        for article in articles.values():
+            self.add(article)
+
+    def add(self, article):
+        """Add an article to the index."""
+        self.hashes.setdefault(article.feed, set()).add(article.hash)
+        id = article.entry_info.get("id")
+        if id is not None:
+            self.ids.setdefault(article.feed, {})[id] = article.hash
+        self.seen(article)
+
+    def seen(self, article):
+        """Update the index after an article's last-seen time has
+        changed."""
+        last_seen = self.last_seen.setdefault(article.feed, {})
+        last_seen[article.hash] = article.last_seen
+        heap = self.last_seen_heaps.setdefault(article.feed, [])
+        heapq.heappush(heap, (article.last_seen, article.hash))
+        if len(heap) > 2 * len(last_seen) + 16:
+            # Too many out-of-date entries; rebuild it.
+            heap[:] = [(t, key) for key, t in last_seen.items()]
+            heapq.heapify(heap)
+
+    def remove(self, article):
+        """Remove an article from the index."""
+        hashes = self.hashes.get(article.feed)
+        if hashes is not None:
+            hashes.discard(article.hash)
+            if len(hashes) == 0:
+                del self.hashes[article.feed]
+                self.last_seen.pop(article.feed, None)
+                self.last_seen_heaps.pop(article.feed, None)
+            else:
+                self.last_seen[article.feed].pop(article.hash, None)
+        id = article.entry_info.get("id")
+        ids = self.ids.get(article.feed)
+        if ids is not None and ids.get(id) == article.hash:
+            del ids[id]
+            if len(ids) == 0:
+                del self.ids[article.feed]
+
+    def remove_feed(self, url):
+        """Remove all the articles from a feed from the index."""
+        self.hashes.pop(url, None)
+        self.ids.pop(url, None)
+        self.last_seen.pop(url, None)
+        self.last_seen_heaps.pop(url, None)
+
+    def feeds(self):
+        """Return the URLs of the feeds that have articles."""
+        return list(self.hashes.keys())
+
+    def feed_hashes(self, url):
+        """Return the set of article hashes for a feed."""
+        return self.hashes.get(url, set())
+
+    def feed_ids(self, url):
+        """Return a dict mapping entry IDs to article hashes for a
+        feed."""
+        return self.ids.get(url, {})
+
+    def seen_before(self, url, before):
+        """Return a list of the hashes of a feed's articles that were
+        last seen before the given time. This only looks at those
+        articles, not at all of the feed's articles."""
+        last_seen = self.last_seen.get(url, {})
+        heap = self.last_seen_heaps.get(url, [])
+        found = {}
+        while heap and heap[0][0] < before:
+            (t, key) = heapq.heappop(heap)
+            if last_seen.get(key) == t:
+                found[key] = t
+        # Put them back; the caller will remove any that it expires.
+        for key, t in found.items():
+            heapq.heappush(heap, (t, key))
+        return list(found)
+
+
 class DayWriter:
     """Utility class for writing day sections into a series of articles."""
 
@@ -739,6 +1341,15 @@ def parse_time(value, default="m"):
     return int(value) * units[default]
 
 
+def format_period(secs):
+    """Format a time period in seconds in the form that parse_time
+    accepts, using the largest unit that divides it exactly."""
+    for unit, size in [("w", 604800), ("d", 86400), ("h", 3600), ("m", 60)]:
+        if secs % size == 0 and secs > 0:
+            return "%d%s" % (secs // size, unit)
+    return "%ds" % secs
+
+
 def parse_bool(value):
     """Parse a boolean value (0, 1, false or true). Raise ValueError if
     the value isn't recognised."""
@@ -756,6 +1367,29 @@ def parse_list(value):
     return value.strip().split(None)
 
 
+def parse_compression(value):
+    """Parse a compression codec name, optionally followed by a
+    compression level, into a (codec, level) tuple. Raise ConfigError
+    if the codec isn't available, or ValueError if the value can't be
+    parsed."""
+    l = value.split()
+    if len(l) not in (1, 2):
+        raise ValueError("Bad compression setting: " + value)
+    codec = l[0]
+    if codec not in ("none", "zlib", "lzma", "zstd"):
+        raise ValueError("Unknown compression codec: " + codec)
+    if codec not in available_codecs():
+        raise ConfigError("The " + codec + " compression codec isn't available")
+    if len(l) == 2:
+        level = int(l[1])
+        (low, high) = {"none": (0, 0), "zlib": (0, 9), "lzma": (0, 9), "zstd": (1, 22)}[codec]
+        if not (low <= level <= high):
+            raise ValueError("Bad compression level: " + l[1])
+    else:
+        level = None
+    return (codec, level)
+
+
 def parse_feed_args(argparams, arglines):
     """Parse a list of feed arguments. Raise ConfigError if the syntax is
     invalid, or ValueError if an argument value can't be parsed."""
@@ -810,6 +1444,7 @@ class Config:
             "maxarticles": 200,
             "maxage": 0,
             "expireage": 24 * 60 * 60,
+            "lastseenslack": 0,
             "keepmin": 0,
             "dayformat": "%A, %d %B %Y",
             "timeformat": "%I:%M %p",
@@ -817,6 +1452,10 @@ class Config:
             "userefresh": False,
             "showfeeds": True,
             "timeout": 30,
+            "maxupdatetime": 0,
+            "adaptiveperiods": False,
+            "maxperiod": 24 * 60 * 60,
+            "maxbackoff": 0,
             "pagetemplate": "default",
             "itemtemplate": "default",
             "feedlisttemplate": "default",
@@ -828,13 +1467,25 @@ class Config:
             "timesections": True,
             "blocklevelhtml": True,
             "tidyhtml": False,
+            "rendercache": True,
             "sortbyfeeddate": False,
             "currentonly": False,
             "hideduplicates": [],
+            "keepfeedinfo": [],
+            "keepentryinfo": [],
             "newfeedperiod": "3h",
             "changeconfig": False,
             "numthreads": 1,
+            "parseprocesses": 0,
+            "hostconnections": 0,
+            "hostdelay": 0,
+            "daemonperiod": 10 * 60,
+            "checkpointperiod": 60 * 60,
+            "fetchbackend": "threads",
             "splitstate": False,
+            "syncstate": True,
+            "statebackend": "pickle",
+            "statecompression": ("none", None),
             "useids": False,
         }
 
@@ -921,6 +1572,8 @@ class Config:
             self["maxage"] = parse_time(l[1])
         elif l[0] == "expireage":
             self["expireage"] = parse_time(l[1])
+        elif l[0] == "lastseenslack":
+            self["lastseenslack"] = parse_time(l[1])
         elif l[0] == "keepmin":
             self["keepmin"] = int(l[1])
         elif l[0] == "dayformat":
@@ -935,6 +1588,14 @@ class Config:
             self["showfeeds"] = parse_bool(l[1])
         elif l[0] == "timeout":
             self["timeout"] = parse_time(l[1], "s")
+        elif l[0] == "maxupdatetime":
+            self["maxupdatetime"] = parse_time(l[1])
+        elif l[0] == "adaptiveperiods":
+            self["adaptiveperiods"] = parse_bool(l[1])
+        elif l[0] == "maxperiod":
+            self["maxperiod"] = parse_time(l[1])
+        elif l[0] == "maxbackoff":
+            self["maxbackoff"] = parse_time(l[1])
         elif l[0] in ("template", "pagetemplate"):
             self["pagetemplate"] = l[1]
         elif l[0] == "itemtemplate":
@@ -957,20 +1618,53 @@ class Config:
             self["blocklevelhtml"] = parse_bool(l[1])
         elif l[0] == "tidyhtml":
             self["tidyhtml"] = parse_bool(l[1])
+        elif l[0] == "rendercache":
+            self["rendercache"] = parse_bool(l[1])
         elif l[0] == "sortbyfeeddate":
             self["sortbyfeeddate"] = parse_bool(l[1])
         elif l[0] == "currentonly":
             self["currentonly"] = parse_bool(l[1])
         elif l[0] == "hideduplicates":
             self["hideduplicates"] = parse_list(l[1])
+        elif l[0] == "keepfeedinfo":
+            self["keepfeedinfo"] = parse_list(l[1])
+        elif l[0] == "keepentryinfo":
+            self["keepentryinfo"] = parse_list(l[1])
         elif l[0] == "newfeedperiod":
             self["newfeedperiod"] = l[1]
         elif l[0] == "changeconfig":
             self["changeconfig"] = parse_bool(l[1])
         elif l[0] == "numthreads":
             self["numthreads"] = int(l[1])
+        elif l[0] == "parseprocesses":
+            if l[1] == "auto":
+                self["parseprocesses"] = os.cpu_count() or 1
+            else:
+                self["parseprocesses"] = int(l[1])
+        elif l[0] == "hostconnections":
+            self["hostconnections"] = int(l[1])
+        elif l[0] == "hostdelay":
+            self["hostdelay"] = parse_time(l[1], "s")
+        elif l[0] == "daemonperiod":
+            self["daemonperiod"] = parse_time(l[1])
+        elif l[0] == "checkpointperiod":
+            self["checkpointperiod"] = parse_time(l[1])
+        elif l[0] == "fetchbackend":
+            if l[1] not in ("threads", "asyncio"):
+                raise ValueError("Bad fetch backend: " + l[1])
+            if l[1] == "asyncio" and importlib.util.find_spec("aiohttp") is None:
+                raise ConfigError("The asyncio fetch backend needs the aiohttp module")
+            self["fetchbackend"] = l[1]
         elif l[0] == "splitstate":
             self["splitstate"] = parse_bool(l[1])
+        elif l[0] == "syncstate":
+            self["syncstate"] = parse_bool(l[1])
+        elif l[0] == "statecompression":
+            self["statecompression"] = parse_compression(l[1])
+        elif l[0] == "statebackend":
+            if l[1] not in ("pickle", "sqlite"):
+                raise ValueError("Bad state backend: " + l[1])
+            self["statebackend"] = l[1]
         elif l[0] == "useids":
             self["useids"] = parse_bool(l[1])
         elif l[0] == "include":
@@ -1014,71 +1708,362 @@ class Config:
 
 
 
+def make_session(config, num_hosts):
+    """Create a requests.Session for fetching feeds from num_hosts
+    different hosts. The session keeps connections to each host open
+    between requests; if the hostconnections option is set, it also
+    limits the number of concurrent connections to each host."""
+    import requests
+    import requests.adapters
+
+    session = requests.Session()
+    session.headers["user-agent"] = HTTP_AGENT
+
+    max_per_host = config["hostconnections"]
+    if max_per_host > 0:
+        # Threads wait for a connection to become free rather than
+        # opening more than max_per_host connections.
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max(num_hosts, 1),
+            pool_maxsize=max_per_host,
+            pool_block=True)
+    else:
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max(num_hosts, 1),
+            pool_maxsize=max(config["numthreads"], 1))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_error():
+    """Return a fetch result for the exception being handled."""
+    return {
+        "rawdog_exception": sys.exc_info()[1],
+        "rawdog_traceback": traceback.format_exc()
+    }
+
+
+def host_unreachable(err):
+    """Return True if a requests ConnectionError means that rawdog
+    couldn't connect to the host at all (the connection was refused,
+    there's no route to it, or its name couldn't be resolved), rather
+    than that something went wrong once it had connected, such as a bad
+    certificate or a connection reset."""
+    import urllib3.exceptions
+    reason = getattr(err.args[0], "reason", None) if err.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+class HostScheduler:
+    """Class that decides which feed to fetch next, so that feeds from
+    different hosts are interleaved, no host has more than max_per_host
+    fetches in progress at once (if max_per_host isn't 0), and fetches
+    from the same host are started at least delay seconds apart. Feeds
+    from each host are fetched in the order given. This doesn't do any
+    locking itself."""
+
+    def __init__(self, feedlist, max_per_host=0, delay=0):
+        self.max_per_host = max_per_host
+        self.delay = delay
+        # Host -> feeds still to fetch from it, in reverse order.
+        self.queues = {}
+        for url in feedlist:
+            self.queues.setdefault(url_host(url), []).append(url)
+        for jobs in self.queues.values():
+            jobs.reverse()
+        # Hosts with feeds still to fetch, in the order to try them.
+        self.hosts = collections.deque(self.queues)
+        self.remaining = len(feedlist)
+        self.active = {}
+        self.next_start = {}
+
+    def is_ready(self, host, now):
+        if self.max_per_host > 0 and self.active.get(host, 0) >= self.max_per_host:
+            return False
+        return now >= self.next_start.get(host, 0)
+
+    def next(self, now):
+        """Return the next feed to fetch, or None if no feed can be
+        fetched yet."""
+        for i, host in enumerate(self.hosts):
+            if self.is_ready(host, now):
+                break
+        else:
+            return None
+
+        # Move the host to the back of the line.
+        del self.hosts[i]
+        jobs = self.queues[host]
+        job = jobs.pop()
+        if jobs:
+            self.hosts.append(host)
+        else:
+            del self.queues[host]
+        self.remaining -= 1
+        self.active[host] = self.active.get(host, 0) + 1
+        self.next_start[host] = now + self.delay
+        return job
+
+    def wait_time(self, now):
+        """Return how long it will be until a feed can be fetched, or
+        None if that won't be until a fetch in progress has finished."""
+        waits = [self.next_start.get(host, 0) - now for host in self.hosts
+                 if self.max_per_host == 0 or self.active.get(host, 0) < self.max_per_host]
+        if not waits:
+            return None
+        return max(min(waits), 0)
+
+    def finished(self, job):
+        """Note that the fetch of a feed has finished."""
+        self.active[url_host(job)] -= 1
+
+    def drop_host(self, host):
+        """Don't fetch any more feeds from a host. Return the feeds that
+        won't be fetched."""
+        jobs = self.queues.pop(host, [])
+        if jobs:
+            self.hosts.remove(host)
+            self.remaining -= len(jobs)
+        return list(reversed(jobs))
+
+    def clear(self):
+        """Don't fetch any more feeds."""
+        self.queues = {}
+        self.hosts.clear()
+        self.remaining = 0
+
+
 class FeedFetcher:
-    """Class that will handle fetching a set of feeds in parallel."""
+    """Class that will handle fetching a set of feeds in parallel.
+    Feeds are fetched in the order given, subject to the hostconnections
+    and hostdelay limits; if deadline is given, no more fetches are
+    started after that time."""
 
-    def __init__(self, rawdog, feedlist, config):
+    def __init__(self, rawdog, feedlist, config, parse_pool=None, deadline=None):
         self.rawdog = rawdog
         self.config = config
-        self.lock = threading.Lock()
-        self.jobs = set(feedlist)
-        self.results = {}
+        self.parse_pool = parse_pool
+        self.deadline = deadline
+        # This is notified whenever a fetch finishes.
+        self.lock = threading.Condition()
+        self.scheduler = HostScheduler(feedlist, config["hostconnections"], config["hostdelay"])
+        self.results = None
+        # The feeds that weren't fetched because their host couldn't be
+        # reached.
+        self.skipped = []
+
+        self.session = make_session(config, len(self.scheduler.queues))
+
+    def fetch(self, job):
+        feed = self.rawdog.feeds[job]
+        try:
+            result = feed.fetch(self.rawdog, self.config, self.session, self.parse_pool)
+        except Exception:
+            result = fetch_error()
+        with self.lock:
+            self.scheduler.finished(job)
+            if result.get("rawdog_host_down") and self.config["maxbackoff"] > 0:
+                self.skipped += self.scheduler.drop_host(url_host(job))
+            self.lock.notify_all()
+        return result
 
-    def worker(self, num):
-        rawdog = self.rawdog
-        config = self.config
+    def next_job(self):
+        """Return the next feed to fetch, waiting until the scheduler
+        allows it, or None if there are none left or the deadline has
+        passed."""
+        with self.lock:
+            while True:
+                now = time.time()
+                if self.deadline is not None and now >= self.deadline:
+                    self.scheduler.clear()
+                if self.scheduler.remaining == 0:
+                    return None
+                job = self.scheduler.next(now)
+                if job is not None:
+                    return job
+                wait = self.scheduler.wait_time(now)
+                if self.deadline is not None:
+                    if wait is None or wait > self.deadline - now:
+                        wait = self.deadline - now
+                self.lock.wait(wait)
 
+    def worker(self, num):
         while True:
-            with self.lock:
-                try:
-                    job = self.jobs.pop()
-                except KeyError:
-                    # No jobs left.
-                    break
-
-            config.log("[", num, "] Fetching feed: ", job)
-            feed = rawdog.feeds[job]
-            result = feed.fetch(rawdog, config)
+            job = self.next_job()
+            if job is None:
+                break
 
-            with self.lock:
-                self.results[job] = result
+            self.config.log("[", num, "] Fetching feed: ", job)
+            self.results.put((job, self.fetch(job)))
+        # Tell run that this worker has finished.
+        self.results.put(None)
 
     def run(self, max_workers):
+        """Fetch the feeds, yielding (url, result) for each feed as
+        soon as it has been fetched. Only a few results are kept
+        waiting at once, so the caller should deal with each one
+        before asking for the next."""
         max_workers = max(max_workers, 1)
-        num_workers = min(max_workers, len(self.jobs))
+        num_workers = min(max_workers, self.scheduler.remaining)
 
-        self.config.log("Fetching ", len(self.jobs), " feeds using ",
+        self.config.log("Fetching ", self.scheduler.remaining, " feeds using ",
                         num_workers, " threads")
+        if num_workers <= 1:
+            # Don't start any threads at all.
+            try:
+                while True:
+                    job = self.next_job()
+                    if job is None:
+                        break
+                    self.config.log("Fetching feed: ", job)
+                    yield (job, self.fetch(job))
+            finally:
+                self.session.close()
+            self.config.log("Fetch complete")
+            return
+
+        # Workers wait once this is full, so at most num_workers * 2
+        # results exist at once.
+        self.results = queue.Queue(num_workers)
         workers = []
-        for i in range(1, num_workers):
+        for i in range(num_workers):
             t = threading.Thread(target=self.worker, args=(i,))
             t.start()
             workers.append(t)
-        self.worker(0)
-        for worker in workers:
-            worker.join()
+        try:
+            running = num_workers
+            while running > 0:
+                result = self.results.get()
+                if result is None:
+                    running -= 1
+                else:
+                    yield result
+        finally:
+            # If we're stopping early, let the workers finish what
+            # they're doing, but don't start any more fetches.
+            with self.lock:
+                self.scheduler.clear()
+                self.lock.notify_all()
+            for worker in workers:
+                while worker.is_alive():
+                    try:
+                        self.results.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                worker.join()
+            self.session.close()
         self.config.log("Fetch complete")
-        return self.results
+
+
+# The Article attributes that are stored alongside each article by
+# persisters that store articles individually.
+ARTICLE_COLUMNS = ("feed", "added", "date", "sequence")
 
 
 class FeedState(Persistable):
     """The collection of articles in a feed."""
 
+    row_attributes = {"articles": ARTICLE_COLUMNS}
+    derived_attributes = ("article_index",)
+    summary_attributes = ("articles",)
+
     def __init__(self):
         Persistable.__init__(self)
         self.articles = {}
+        self.article_index = ArticleIndex()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "article_index" not in state:
+            # It's not saved along with the articles.
+            self.article_index = ArticleIndex(self.articles)
+
+
+class RenderCache(Persistable):
+    """The HTML that articles were rendered into by the last write, so
+    that articles that haven't changed don't need rendering again."""
+
+    row_attributes = {"items": ()}
+
+    def __init__(self):
+        Persistable.__init__(self)
+        self.fingerprint = None
+        # Article hash -> (key, html).
+        self.items = {}
+        self.used = set()
+
+    def __getstate__(self):
+        state = Persistable.__getstate__(self)
+        del state["used"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.used = set()
+
+    def set_fingerprint(self, fingerprint):
+        """Set the fingerprint of everything other than the article
+        that affects rendering; if it's changed, discard everything
+        that was rendered before."""
+        if fingerprint != self.fingerprint:
+            self.fingerprint = fingerprint
+            self.items = {}
+            self.modified()
+
+    def get(self, hash, key):
+        """Return the HTML for an article, or None if it hasn't been
+        rendered with the same key."""
+        self.used.add(hash)
+        item = self.items.get(hash)
+        if item is not None and item[0] == key:
+            return item[1]
+        return None
+
+    def put(self, hash, key, html):
+        self.used.add(hash)
+        self.items[hash] = (key, html)
+        self.modified()
+
+    def prune(self):
+        """Discard the articles that weren't used by this write."""
+        for hash in list(self.items.keys()):
+            if hash not in self.used:
+                del self.items[hash]
+                self.modified()
+        self.used = set()
 
 
 class Rawdog(Persistable):
     """The aggregator itself."""
 
+    row_attributes = {
+        "feeds": (),
+        "articles": ARTICLE_COLUMNS,
+        "plugin_storage": (),
+    }
+    derived_attributes = ("article_index",)
+
     def __init__(self):
         Persistable.__init__(self)
         self.feeds = {}
         self.articles = {}
+        self.article_index = ArticleIndex()
         self.plugin_storage = {}
         self.state_version = STATE_VERSION
         self.using_splitstate = None
+        # Host -> (number of failures in a row, time before which
+        # feeds from it shouldn't be fetched) for hosts that couldn't
+        # be reached.
+        self.dead_hosts = {}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "article_index" not in state:
+            # It's not saved along with the articles.
+            self.article_index = ArticleIndex(self.articles)
+        if "dead_hosts" not in state:
+            self.dead_hosts = {}
 
     def check_state_version(self):
         """Check the version of the state file."""
@@ -1098,6 +2083,24 @@ class Rawdog(Persistable):
             print("  Hash:", short_hash(url))
             print("  Title:", feed.get_html_name(config))
             print("  Link:", feed_info.get("link"))
+            if feed.effective_period is not None:
+                print("  Adaptive period:", format_period(feed.effective_period))
+            if feed.failures > 0:
+                print("  Failures:", feed.failures)
+            until = max(feed.backoff_until, self.get_host_retry_time(url))
+            if until > time.time():
+                print("  Suppressed until:", format_time(until, config))
+
+    def get_host_retry_time(self, url):
+        """Return the time before which feeds from url's host shouldn't
+        be fetched, because it couldn't be reached."""
+        return self.dead_hosts.get(url_host(url), (0, 0))[1]
+
+    def record_host_failure(self, host, now, config):
+        """Note that a host couldn't be reached, and don't fetch feeds
+        from it again for a while."""
+        failures = self.dead_hosts.get(host, (0, 0))[0] + 1
+        self.dead_hosts[host] = (failures, now + backoff_delay(BACKOFF_BASE, failures, config["maxbackoff"]))
 
     def sync_from_config(self, config):
         """Update rawdog's internal state to match the
@@ -1126,19 +2129,24 @@ class Rawdog(Persistable):
                 for feed_hash, feed in list(self.feeds.items()):
                     with persister.get(FeedState, feed.get_state_filename()) as feedstate:
                         feedstate.articles = {}
-                        for article_hash, article in list(self.articles.items()):
-                            if article.feed == feed_hash:
-                                feedstate.articles[article_hash] = article
+                        for article_hash in self.article_index.feed_hashes(feed_hash):
+                            feedstate.articles[article_hash] = self.articles[article_hash]
+                        feedstate.article_index = ArticleIndex(feedstate.articles)
                         feedstate.modified()
+                    feed.summarise_articles(self.articles, self.article_index)
                 self.articles = {}
+                self.article_index = ArticleIndex()
             else:
                 config.log("Converting to single state file")
                 self.articles = {}
+                self.article_index = ArticleIndex()
                 for feed_hash, feed in list(self.feeds.items()):
                     with persister.get(FeedState, feed.get_state_filename()) as feedstate:
                         for article_hash, article in list(feedstate.articles.items()):
                             self.articles[article_hash] = article
+                            self.article_index.add(article)
                         feedstate.articles = {}
+                        feedstate.article_index = ArticleIndex()
                         feedstate.modified()
                     persister.delete(feed.get_state_filename())
             self.modified()
@@ -1155,6 +2163,14 @@ class Rawdog(Persistable):
             if feed.period != period:
                 config.log("Changed feed period: ", url)
                 feed.period = period
+                # The adaptive period was worked out from the old one,
+                # so it'll be worked out again after the next update.
+                feed.effective_period = None
+                self.modified()
+            if not config["adaptiveperiods"] and (feed.effective_period is not None
+                                                  or feed.not_before != 0):
+                feed.effective_period = None
+                feed.not_before = 0
                 self.modified()
             newargs = {}
             newargs.update(config["feeddefaults"])
@@ -1169,9 +2185,9 @@ class Rawdog(Persistable):
                 if config["splitstate"]:
                     persister.delete(self.feeds[url].get_state_filename())
                 else:
-                    for key, article in list(self.articles.items()):
-                        if article.feed == url:
-                            del self.articles[key]
+                    for key in self.article_index.feed_hashes(url):
+                        del self.articles[key]
+                    self.article_index.remove_feed(url)
                 del self.feeds[url]
                 self.modified()
 
@@ -1194,81 +2210,147 @@ class Rawdog(Persistable):
             config.warn("No such feed: ", feedurl)
             update_feeds = []
 
+        if config["maxbackoff"] <= 0:
+            self.dead_hosts = {}
+        elif feedurl is None:
+            # Skip feeds on hosts that are known to be down, until it's
+            # time to try them again.
+            suppressed = set(url for url in update_feeds
+                             if now < self.get_host_retry_time(url))
+            if suppressed:
+                config.log("Skipping ", len(suppressed), " feeds on hosts that are down")
+                update_feeds = [url for url in update_feeds
+                                if url not in suppressed]
+
+        # Fetch the most overdue feeds first, so that if we run out
+        # of time, they won't be left waiting again.
+        update_feeds.sort(key=lambda url: self.feeds[url].get_overdue(now),
+                          reverse=True)
+
         numfeeds = len(update_feeds)
         config.log("Will update ", numfeeds, " feeds")
 
-        fetcher = FeedFetcher(self, update_feeds, config)
-        fetched = fetcher.run(config["numthreads"])
+        deadline = None
+        if config["maxupdatetime"] > 0:
+            deadline = now + config["maxupdatetime"]
 
         seen_some_items = set()
 
-        def do_expiry(articles):
-            """Expire articles from a list. Return True if any
-            articles were expired."""
-
-            feedcounts = {}
-            for key, article in list(articles.items()):
-                url = article.feed
-                feedcounts[url] = feedcounts.get(url, 0) + 1
-
-            expiry_list = []
-            feedcounts = {}
-            for key, article in list(articles.items()):
-                url = article.feed
-                feedcounts[url] = feedcounts.get(url, 0) + 1
-                expiry_list.append((article.added, article.sequence, key, article))
-            expiry_list.sort()
+        def do_expiry(articles, index, urls):
+            """Expire old articles belonging to the feeds in urls from
+            a collection, keeping its index up to date. Return True if
+            any articles were expired."""
 
             count = 0
-            for date, seq, key, article in expiry_list:
-                url = article.feed
+
+            # Articles from feeds that no longer exist can all go.
+            for url in index.feeds():
                 if url not in self.feeds:
-                    config.log("Expired article for nonexistent feed: ", url)
-                    count += 1
-                    del articles[key]
+                    hashes = index.feed_hashes(url)
+                    config.log("Expired ", len(hashes), " articles for nonexistent feed: ", url)
+                    count += len(hashes)
+                    for key in hashes:
+                        del articles[key]
+                    index.remove_feed(url)
+
+            # For each feed, we can expire articles until it's down to
+            # keepmin articles, oldest first. The index finds the
+            # articles that can expire without looking at the rest.
+            before = expire_before(now, config)
+            for url in urls:
+                hashes = index.feed_hashes(url)
+                max_expire = len(hashes) - self.feeds[url].get_keepmin(config)
+                if max_expire <= 0:
                     continue
-                if (url in seen_some_items
-                        and url in self.feeds
-                        and article.can_expire(now, config)
-                        and feedcounts[url] > self.feeds[url].get_keepmin(config)):
+
+                expirable = []
+                for key in index.seen_before(url, before):
+                    article = articles[key]
+                    expirable.append((article.added, article.sequence, key))
+
+                for added, seq, key in heapq.nsmallest(max_expire, expirable):
                     count += 1
-                    feedcounts[url] -= 1
+                    index.remove(articles[key])
                     del articles[key]
+
             config.log("Expired ", count, " articles, leaving ", len(articles))
 
             return count > 0
 
         count = 0
-        for url in update_feeds:
-            count += 1
-            config.log("Updating feed ", count, " of ", numfeeds, ": ", url)
-            feed = self.feeds[url]
-
-            if config["splitstate"]:
-                feedstate_p = persister.get(FeedState, feed.get_state_filename())
-                feedstate = feedstate_p.open()
-                articles = feedstate.articles
-            else:
-                articles = self.articles
+        not_modified = 0
+        deltas = 0
+        down_hosts = set()
+        # Each feed is merged as soon as it's been fetched, so that
+        # only a few fetched feeds are kept in memory at once.
+        parse_pool = make_parse_pool(config, numfeeds)
+        if config["fetchbackend"] == "asyncio":
+            from rawdoglib.asyncfetch import AsyncFeedFetcher
+            fetcher = AsyncFeedFetcher(self, update_feeds, config, parse_pool, deadline)
+        else:
+            fetcher = FeedFetcher(self, update_feeds, config, parse_pool, deadline)
+        try:
+            for url, content in fetcher.run(config["numthreads"]):
+                count += 1
+                config.log("Updating feed ", count, " of ", numfeeds, ": ", url)
+                feed = self.feeds[url]
+
+                if config["maxbackoff"] > 0:
+                    host = url_host(url)
+                    if content.get("rawdog_host_down"):
+                        if host not in down_hosts:
+                            self.record_host_failure(host, now, config)
+                            down_hosts.add(host)
+                    elif "rawdog_responses" in content:
+                        # It's answering again.
+                        self.dead_hosts.pop(host, None)
 
-            content = fetched[url]
-            rc = feed.update(self, now, config, articles, content)
-            url = feed.url
-            if rc:
-                seen_some_items.add(url)
                 if config["splitstate"]:
+                    feedstate_p = persister.get(FeedState, feed.get_state_filename())
+                    feedstate = feedstate_p.open()
+                    articles = feedstate.articles
+                    index = feedstate.article_index
+                else:
+                    articles = self.articles
+                    index = self.article_index
+
+                responses = content.get("rawdog_responses", [])
+                if len(responses) > 0 and responses[-1]["status"] == 304:
+                    not_modified += 1
+                elif len(responses) > 0 and responses[-1]["status"] == 226:
+                    deltas += 1
+                (rc, changed) = feed.update(self, now, config, articles, content, index)
+                feed.adapt_period(now, config, content)
+                url = feed.url
+                if rc:
+                    seen_some_items.add(url)
+                if changed and config["splitstate"]:
                     feedstate.modified()
 
-            if config["splitstate"]:
-                if do_expiry(articles):
-                    feedstate.modified()
-                feedstate_p.close()
+                if config["splitstate"]:
+                    if rc and do_expiry(articles, index, [url]):
+                        feedstate.modified()
+                    feed.summarise_articles(articles, index)
+                    feedstate_p.close()
+        finally:
+            if parse_pool is not None:
+                parse_pool.shutdown()
 
         if config["splitstate"]:
             self.articles = {}
+            self.article_index = ArticleIndex()
         else:
-            do_expiry(self.articles)
-
+            do_expiry(self.articles, self.article_index, seen_some_items)
+
+        if fetcher.skipped:
+            config.log("Skipped ", len(fetcher.skipped), " feeds on hosts that went down")
+        if count + len(fetcher.skipped) < numfeeds:
+            # The others will still be due next time, and will be
+            # first in line then.
+            config.log("Ran out of time after ", count, " of ", numfeeds,
+                       " feeds; the rest will be updated next time")
+        config.log(not_modified, " of ", count, " feeds were not modified; ",
+                   deltas, " sent deltas")
         self.modified()
         config.log("Finished update")
 
@@ -1356,8 +2438,47 @@ __feeditems__
         except KeyError:
             config.warn("Unknown template name: ", name)
 
-    def write_article(self, f, article, config):
-        """Write an article to the given file."""
+    def get_render_fingerprint(self, config):
+        """Return a fingerprint of the configuration that affects how
+        all articles are rendered."""
+        h = hashlib.sha1()
+        parts = [VERSION, self.get_template(config, "item"),
+                 locale.setlocale(locale.LC_TIME), repr(time.tzname)]
+        parts += [repr(config[k]) for k in RENDER_CONFIG_KEYS]
+        for part in parts:
+            h.update(part.encode())
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def get_render_key(self, article, config):
+        """Return a key that changes whenever the article, or the parts
+        of its feed that may be used in rendering it, change."""
+        feed = self.feeds[article.feed]
+        parts = [article.revision, article.date, article.added, feed.url,
+                 sorted(feed.args.items()),
+                 feed.feed_info.get("title_detail"), feed.feed_info.get("link")]
+        itemtemplate = self.get_template(config, "item")
+        if "feed_last_update__" in itemtemplate or "feed_next_update__" in itemtemplate:
+            parts += [feed.last_update, feed.get_period()]
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def write_article(self, f, article, config, render_cache=None, feed_bits_cache=None):
+        """Write an article to the given file. If render_cache is
+        given, reuse the HTML from it if the article's already been
+        rendered, and store it there if not."""
+        if render_cache is None:
+            f.write(self.render_article(article, config, feed_bits_cache))
+            return
+
+        key = self.get_render_key(article, config)
+        html = render_cache.get(article.hash, key)
+        if html is None:
+            html = self.render_article(article, config, feed_bits_cache)
+            render_cache.put(article.hash, key, html)
+        f.write(html)
+
+    def render_article(self, article, config, feed_bits_cache=None):
+        """Return the HTML for an article."""
         feed = self.feeds[article.feed]
         entry_info = article.entry_info
 
@@ -1369,7 +2490,7 @@ __feeditems__
         if guid == "":
             guid = None
 
-        itembits = self.get_feed_bits(config, feed)
+        itembits = self.get_feed_bits(config, feed, feed_bits_cache)
         for name, value in list(feed.args.items()):
             if name.startswith("define_"):
                 itembits[name[7:]] = sanitise_html(value, "", True, config)
@@ -1428,7 +2549,7 @@ __feeditems__
             itembits["date"] = ""
 
         itemtemplate = self.get_template(config, "item")
-        f.write(fill_template(itemtemplate, itembits))
+        return fill_template(itemtemplate, itembits)
 
     def write_remove_dups(self, articles, config, now):
         """Filter the list of articles to remove articles that are too
@@ -1473,8 +2594,13 @@ __feeditems__
             kept_articles.append(article)
         return (kept_articles, dup_count)
 
-    def get_feed_bits(self, config, feed):
-        """Get the bits that are used to describe a feed."""
+    def get_feed_bits(self, config, feed, cache=None):
+        """Get the bits that are used to describe a feed. If cache is
+        given, it is a dict that the bits for each feed are kept in, so
+        they're only worked out once during a write."""
+
+        if cache is not None and feed.url in cache:
+            return dict(cache[feed.url])
 
         bits = {"feed_id": feed.get_id(config), "feed_hash": short_hash(feed.url),
                 "feed_title": feed.get_html_link(config),
@@ -1482,72 +2608,106 @@ __feeditems__
                 "feed_url": string_to_html(feed.url, config),
                 "feed_icon": '<a class="xmlbutton" href="' + html_escape(feed.url) + '">XML</a>',
                 "feed_last_update": format_time(feed.last_update, config),
-                "feed_next_update": format_time(feed.last_update + feed.period, config)}
+                "feed_next_update": format_time(feed.last_update + feed.get_period(), config)}
+        if cache is not None:
+            cache[feed.url] = dict(bits)
         return bits
 
-    def write_feeditem(self, f, feed, config):
+    def write_feeditem(self, f, feed, config, feed_bits_cache=None):
         """Write a feed list item."""
-        bits = self.get_feed_bits(config, feed)
+        bits = self.get_feed_bits(config, feed, feed_bits_cache)
         f.write(fill_template(self.get_template(config, "feeditem"), bits))
 
-    def write_feedlist(self, f, config):
+    def write_feedlist(self, f, config, feed_bits_cache=None):
         """Write the feed list."""
         bits = {}
 
         feeds = [(feed.get_html_name(config).lower(), feed)
                  for feed in list(self.feeds.values())]
-        feeds.sort()
+        # Feeds can have the same name, and Feeds can't be compared.
+        feeds.sort(key=lambda x: (x[0], x[1].url))
 
         feeditems = StringIO()
         for key, feed in feeds:
-            self.write_feeditem(feeditems, feed, config)
+            self.write_feeditem(feeditems, feed, config, feed_bits_cache)
         bits["feeditems"] = feeditems.getvalue()
         feeditems.close()
 
         f.write(fill_template(self.get_template(config, "feedlist"), bits))
 
-    def get_main_template_bits(self, config):
+    def get_main_template_bits(self, config, feed_bits_cache=None):
         """Get the bits that are used in the default main template,
         with the exception of items and num_items."""
         bits = {"version": VERSION}
         bits.update(config["defines"])
 
         refresh = min([config["expireage"]]
-                      + [feed.period for feed in list(self.feeds.values())])
+                      + [feed.get_period() for feed in list(self.feeds.values())])
         bits["refresh"] = '<meta http-equiv="Refresh" content="' + str(refresh) + '">'
 
         f = StringIO()
-        self.write_feedlist(f, config)
+        self.write_feedlist(f, config, feed_bits_cache)
         bits["feeds"] = f.getvalue()
         f.close()
         bits["num_feeds"] = str(len(self.feeds))
 
         return bits
 
-    def write_output_file(self, articles, article_dates, config):
-        """Write a regular rawdog HTML output file."""
-        f = StringIO()
+    def write_items(self, f, articles, article_dates, config, render_cache=None,
+                    feed_bits_cache=None):
+        """Write the articles, divided into day sections, to f."""
         dw = DayWriter(f, config)
 
         for article in articles:
             dw.time(article_dates[article])
 
-            self.write_article(f, article, config)
+            self.write_article(f, article, config, render_cache, feed_bits_cache)
 
         dw.close()
 
-        bits = self.get_main_template_bits(config)
-        bits["items"] = f.getvalue()
-        f.close()
+    def write_output_file(self, articles, article_dates, config, render_cache=None,
+                          feed_bits_cache=None):
+        """Write a regular rawdog HTML output file."""
+        bits = self.get_main_template_bits(config, feed_bits_cache)
         bits["num_items"] = str(len(articles))
-        s = fill_template(self.get_template(config, "page"), bits)
+        template = self.get_template(config, "page")
+
+        # Rather than building the items into a string and then
+        # filling in the page template, fill in the template with a
+        # marker in place of the items, and write the items out
+        # between the parts before and after the marker. This only
+        # works if the items appear once in the page, and the page
+        # doesn't depend on whether there are any items.
+        parts = None
+        if len(articles) > 0:
+            bits["items"] = ITEMS_MARKER
+            parts = fill_template(template, bits).split(ITEMS_MARKER)
+            if len(parts) != 2:
+                parts = None
+
         outputfile = config["outputfile"]
         if outputfile == "-":
-            print(s)
+            f = sys.stdout
         else:
             config.log("Writing output file: ", outputfile)
             f = open(outputfile + ".new", "w")
-            f.write(s)
+
+        if parts is not None:
+            f.write(parts[0])
+            self.write_items(f, articles, article_dates, config, render_cache,
+                             feed_bits_cache)
+            f.write(parts[1])
+        else:
+            items = StringIO()
+            self.write_items(items, articles, article_dates, config, render_cache,
+                             feed_bits_cache)
+            bits["items"] = items.getvalue()
+            items.close()
+            f.write(fill_template(template, bits))
+
+        if outputfile == "-":
+            f.write("\n")
+        else:
             f.close()
             os.rename(outputfile + ".new", outputfile)
 
@@ -1557,26 +2717,92 @@ __feeditems__
         config.log("Starting write")
         now = time.time()
 
+        # This only lasts for the write, since feeds may be updated
+        # between writes.
+        feed_bits_cache = {}
+        self.write_articles(config, now, feed_bits_cache)
+
+        config.log("Finished write")
+
+    def write_articles(self, config, now, feed_bits_cache=None):
+        """Select the articles to write and write the output file."""
+
         def list_articles(articles):
             return [(-a.get_sort_date(config), a.feed, a.sequence, a.hash) for a in list(articles.values())]
 
+        def list_rows(rows):
+            # As list_articles, but for the rows returned by
+            # persister.list_rows.
+            l = []
+            for (hash, feed_url, added, date, sequence) in rows:
+                if config["sortbyfeeddate"]:
+                    sort_date = date or added
+                else:
+                    sort_date = added
+                l.append((-sort_date, feed_url, sequence, hash))
+            return l
+
+        maxarticles = config["maxarticles"]
+
+        # Articles that have already been loaded, by hash.
+        found = {}
+
         if config["splitstate"]:
+            # Look at the feeds with the newest articles first (and
+            # those we don't know about before any of them). Once we
+            # have maxarticles articles, a feed whose newest article is
+            # older than all of them can't contribute to the output,
+            # and nor can any of the feeds after it.
+            def newest_first(feed):
+                newest = feed.get_newest_sort_date(config)
+                if newest is None:
+                    return float("-inf")
+                return -newest
+            feeds = sorted(self.feeds.values(), key=newest_first)
+
+            # If a feed has a summary of its articles, the summary can
+            # be listed without loading the articles. If not, the
+            # feed's state must be loaded, so hang on to the articles
+            # that might be written so it doesn't need loading again.
             article_list = []
-            for feed in list(self.feeds.values()):
-                with persister.get(FeedState, feed.get_state_filename()) as feedstate:
-                    article_list += list_articles(feedstate.articles)
+            numarticles = 0
+            for i, feed in enumerate(feeds):
+                newest = feed.get_newest_sort_date(config)
+                if (maxarticles != 0 and len(article_list) == maxarticles
+                        and newest is not None and newest < -article_list[-1][0]):
+                    numarticles += sum(f.article_summary[0] for f in feeds[i:])
+                    break
+
+                filename = feed.get_state_filename()
+                rows = persister.list_rows(FeedState, filename, "articles")
+                if rows is not None:
+                    feed_list = list_rows(rows)
+                else:
+                    with persister.get(FeedState, filename) as feedstate:
+                        feed_list = list_articles(feedstate.articles)
+                        found.update(feedstate.articles)
+                numarticles += len(feed_list)
+                if maxarticles != 0:
+                    article_list = heapq.nsmallest(maxarticles, article_list + feed_list)
+                    if rows is None:
+                        keep = set(hash for (date, feed_url, seq, hash) in article_list)
+                        found = dict((hash, a) for (hash, a) in found.items() if hash in keep)
+                else:
+                    article_list += feed_list
         else:
             article_list = list_articles(self.articles)
-        numarticles = len(article_list)
-
-        article_list.sort()
+            numarticles = len(article_list)
+            if maxarticles != 0:
+                article_list = heapq.nsmallest(maxarticles, article_list)
 
-        if config["maxarticles"] != 0:
-            article_list = article_list[:config["maxarticles"]]
+        if maxarticles == 0:
+            article_list.sort()
 
         if config["splitstate"]:
             wanted = {}
             for (date, feed_url, seq, hash) in article_list:
+                if hash in found:
+                    continue
                 if feed_url not in self.feeds:
                     # This can happen if you've managed to
                     # kill rawdog between it updating a
@@ -1586,7 +2812,6 @@ __feeditems__
                     continue
                 wanted.setdefault(feed_url, []).append(hash)
 
-            found = {}
             for (feed_url, article_hashes) in list(wanted.items()):
                 feed = self.feeds[feed_url]
                 with persister.get(FeedState, feed.get_state_filename()) as feedstate:
@@ -1611,9 +2836,205 @@ __feeditems__
         config.log("Selected ", len(articles), " of ", numarticles, " articles to write; ignored ", dup_count,
                    " duplicates")
 
-        self.write_output_file(articles, article_dates, config)
+        if config["rendercache"]:
+            with persister.get(RenderCache, "rendercache") as render_cache:
+                render_cache.set_fingerprint(self.get_render_fingerprint(config))
+                self.write_output_file(articles, article_dates, config, render_cache,
+                                       feed_bits_cache)
+                render_cache.prune()
+        else:
+            self.write_output_file(articles, article_dates, config,
+                                   feed_bits_cache=feed_bits_cache)
+
 
-        config.log("Finished write")
+# The Unix socket that a running daemon listens on, in the state dir.
+DAEMON_SOCKET = "rawdog.sock"
+
+# The actions that can be sent to a running daemon, and the commands
+# used to send them.
+DAEMON_ACTIONS = {
+    "-f": "update-feed",
+    "--update-feed": "update-feed",
+    "-u": "update",
+    "--update": "update",
+    "-w": "write",
+    "--write": "write",
+}
+
+
+class Daemon:
+    """Class that keeps the aggregator's state in memory, updating feeds
+    and writing the output every daemonperiod, and saving the state
+    every checkpointperiod. It reloads the config on SIGHUP, stops on
+    SIGTERM or SIGINT, and accepts commands from send_to_daemon on a
+    Unix socket."""
+
+    def __init__(self, rawdog, rawdog_p, config, verbose=False):
+        self.rawdog = rawdog
+        self.rawdog_p = rawdog_p
+        self.config = config
+        self.verbose = verbose
+        self.stopping = False
+        self.reload_pending = False
+
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reload_pending = True
+        else:
+            self.stopping = True
+
+    def reload(self):
+        config = self.config
+        old_config = config.config
+        try:
+            config.reload()
+        except ConfigError as err:
+            config.warn(err)
+            config.warn("Keeping the old config")
+            config.config = old_config
+            return
+        if self.verbose:
+            config["verbose"] = True
+        # Template files may have been edited too.
+        file_cache.clear()
+        self.rawdog.sync_from_config(config)
+
+    def checkpoint(self):
+        self.config.log("Saving state")
+        self.rawdog_p.save()
+        persister.sync()
+
+    def report_error(self, what, err):
+        """Warn about an exception that the daemon is going to carry on
+        after."""
+        self.config.warn("Error while ", what, ": ", err)
+        if self.config["showtracebacks"]:
+            self.config.warn(traceback.format_exc())
+
+    def run_command(self, line):
+        """Run a command sent by send_to_daemon, returning the response
+        to send back."""
+        l = line.split(None, 1)
+        try:
+            if l == ["update"]:
+                self.rawdog.update(self.config)
+            elif len(l) == 2 and l[0] == "update-feed":
+                self.rawdog.update(self.config, l[1])
+            elif l == ["write"]:
+                self.rawdog.write(self.config)
+            else:
+                return "error: unknown command: " + line
+        except Exception as err:
+            self.report_error("running " + line, err)
+            return "error: " + str(err)
+        return "ok"
+
+    def handle_client(self, conn):
+        with conn:
+            # Don't let a client that connects but never sends anything
+            # stop the daemon.
+            conn.settimeout(self.config["timeout"])
+            f = conn.makefile("rw", encoding="utf-8")
+            try:
+                for line in f:
+                    f.write(self.run_command(line.strip()) + "\n")
+                    f.flush()
+            except OSError:
+                # The client went away or timed out.
+                pass
+
+    def run(self):
+        config = self.config
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # As we hold the lock on the state, any existing socket must
+        # have been left behind by a daemon that didn't exit cleanly.
+        try:
+            os.unlink(DAEMON_SOCKET)
+        except OSError:
+            pass
+        listener.bind(DAEMON_SOCKET)
+        listener.listen(5)
+
+        # Signals wake up select by writing to this socket.
+        (wakeup_r, wakeup_w) = socket.socketpair()
+        wakeup_r.setblocking(False)
+        wakeup_w.setblocking(False)
+        old_wakeup_fd = signal.set_wakeup_fd(wakeup_w.fileno())
+        signums = (signal.SIGHUP, signal.SIGINT, signal.SIGTERM)
+        old_handlers = [signal.signal(signum, self.handle_signal) for signum in signums]
+
+        config.log("Daemon started, listening on ", DAEMON_SOCKET)
+        next_cycle = time.time()
+        next_checkpoint = next_cycle + config["checkpointperiod"]
+        try:
+            while not self.stopping:
+                if self.reload_pending:
+                    self.reload_pending = False
+                    self.reload()
+
+                now = time.time()
+                if now >= next_cycle:
+                    try:
+                        self.rawdog.update(config)
+                        self.rawdog.write(config)
+                    except Exception as err:
+                        self.report_error("updating", err)
+                    next_cycle = time.time() + config["daemonperiod"]
+                if now >= next_checkpoint:
+                    self.checkpoint()
+                    next_checkpoint = time.time() + config["checkpointperiod"]
+                if self.stopping or self.reload_pending:
+                    continue
+
+                timeout = max(min(next_cycle, next_checkpoint) - time.time(), 0)
+                (ready, _, _) = select.select([listener, wakeup_r], [], [], timeout)
+                if wakeup_r in ready:
+                    try:
+                        while wakeup_r.recv(64):
+                            pass
+                    except BlockingIOError:
+                        pass
+                if listener in ready:
+                    (conn, _) = listener.accept()
+                    self.handle_client(conn)
+        finally:
+            for signum, handler in zip(signums, old_handlers):
+                signal.signal(signum, handler)
+            signal.set_wakeup_fd(old_wakeup_fd)
+            wakeup_r.close()
+            wakeup_w.close()
+            listener.close()
+            os.unlink(DAEMON_SOCKET)
+            self.checkpoint()
+        config.log("Daemon stopped")
+
+
+def send_to_daemon(optlist):
+    """If a daemon is running in the current directory, send it the
+    actions in optlist, and return the exit status. Return None if
+    there's no daemon running."""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(DAEMON_SOCKET)
+    except OSError:
+        conn.close()
+        return None
+
+    rc = 0
+    with conn:
+        f = conn.makefile("rw", encoding="utf-8")
+        for o, a in optlist:
+            command = DAEMON_ACTIONS[o]
+            if a != "":
+                command += " " + a
+            f.write(command + "\n")
+            f.flush()
+            response = f.readline().strip()
+            if response != "ok":
+                print("Daemon: " + (response or "no response"))
+                rc = 1
+                break
+    return rc
 
 
 def usage():
@@ -1627,6 +3048,8 @@ General options (use only once):
 -v, --verbose                Print more detailed status information
 -V|--log FILE                Append detailed status information to FILE
 -W, --no-lock-wait           Exit silently if state file is locked
+--daemon                     After performing the other actions, keep
+                             running, updating and writing periodically
 
 Actions (performed in order given):
 -a|--add URL                 Try to find a feed associated with URL and
@@ -1640,6 +3063,9 @@ Actions (performed in order given):
 -u, --update                 Fetch data from feeds and store it
 -w, --write                  Write out HTML output
 
+If a daemon is running in the state dir and only -f, -u and -w are given,
+they're sent to the daemon to perform.
+
 Special actions (all other options are ignored if one of these is specified):
 --dump URL                   Show what rawdog's parser returns for URL
 --find URL                   Show what rawdog's feed finder returns for URL
@@ -1658,6 +3084,7 @@ def main(argv):
         LONGOPTS = [
             "add=",
             "config=",
+            "daemon",
             "dir=",
             "dump=",
             "find=",
@@ -1693,12 +3120,15 @@ def main(argv):
     logfile_name = None
     locking = True
     no_lock_wait = False
+    daemon = False
     for o, a in optlist:
         if o == "--dump":
             import pprint
+            import feedparser
             pprint.pprint(feedparser.parse(a, agent=HTTP_AGENT))
             return 0
         elif o == "--find":
+            import rawdoglib.feedscanner
             feeds = rawdoglib.feedscanner.feeds(a, agent=HTTP_AGENT)
             if len(feeds) == 0:
                 return 1
@@ -1718,6 +3148,8 @@ def main(argv):
             logfile_name = a
         elif o in ("-W", "--no-lock-wait"):
             no_lock_wait = True
+        elif o == "--daemon":
+            daemon = True
     if statedir is None:
         print("$HOME not set and state dir not explicitly specified; please use -d/--dir")
         return 1
@@ -1728,6 +3160,15 @@ def main(argv):
         print("No " + statedir + " directory")
         return 1
 
+    actions = [(o, a) for o, a in optlist
+               if o not in ("-d", "--dir", "-N", "--no-locking", "-v", "--verbose",
+                            "-V", "--log", "-W", "--no-lock-wait")]
+    if (not daemon and actions != []
+            and all(o in DAEMON_ACTIONS for o, a in actions)):
+        rc = send_to_daemon(actions)
+        if rc is not None:
+            return rc
+
     sys.path.append(".")
 
     config = Config(locking, logfile_name)
@@ -1748,7 +3189,18 @@ def main(argv):
         return rc
 
     global persister
-    persister = Persister(config)
+    if config["statebackend"] == "sqlite":
+        persister = SQLitePersister(config, "state.sqlite")
+    elif os.path.exists("state.sqlite"):
+        # Starting again with empty pickle files would silently throw
+        # away everything in the database.
+        print("The state is stored in " + statedir + "/state.sqlite, but the")
+        print("statebackend option is set to pickle. rawdog can't move state")
+        print("out of the database; set statebackend back to sqlite, or remove")
+        print("state.sqlite to start again with empty state.")
+        return 1
+    else:
+        persister = Persister(config)
 
     rawdog_p = persister.get(Rawdog, "state")
     rawdog = rawdog_p.open(no_block=no_lock_wait)
@@ -1783,8 +3235,12 @@ def main(argv):
         elif o in ("-w", "--write"):
             rawdog.write(config)
 
+    if daemon:
+        Daemon(rawdog, rawdog_p, config, verbose).run()
+
     call_hook("shutdown", rawdog, config)
 
     rawdog_p.close()
+    persister.sync()
 
     return 0
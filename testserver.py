@@ -117,6 +117,23 @@ class HTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             self.end_headers()
             return None
 
+        # Request for a file that has a Last-Modified date rather than
+        # an ETag.
+        use_last_modified = False
+        m = re.match(r'^/lastmod(/.*)$', self.path)
+        if m:
+            use_last_modified = True
+            self.path = m.group(1)
+
+        # Request for a file that can be sent as an RFC 3229 delta. If
+        # the client asks for "A-IM: feed" and already has a version of
+        # the file, FILE.delta is sent instead, with a 226 response.
+        use_delta = False
+        m = re.match(r'^/delta(/.*)$', self.path)
+        if m:
+            use_delta = True
+            self.path = m.group(1)
+
         encoding = None
         m = re.match(r'^/(gzip)(/.*)$', self.path)
         if m:
@@ -138,13 +155,26 @@ class HTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             # Use the SHA1 hash as an ETag.
             etag = '"' + hashlib.sha1(f.read()).hexdigest() + '"'
             f.seek(0)
-
-            # Oversimplistic, but matches what feedparser sends.
-            if self.headers.get("If-None-Match", "") == etag:
+            last_modified = self.date_time_string(os.fstat(f.fileno()).st_mtime)
+
+            # Oversimplistic, but matches what rawdog sends.
+            if use_last_modified:
+                not_modified = (self.headers.get("If-Modified-Since", "") == last_modified)
+            else:
+                not_modified = (self.headers.get("If-None-Match", "") == etag)
+            if not_modified:
                 self.send_response(304)
                 self.end_headers()
                 return None
 
+            status = 200
+            if (use_delta
+                    and "feed" in self.headers.get("A-IM", "")
+                    and "If-None-Match" in self.headers):
+                f.close()
+                f = open(filename + ".delta", "rb")
+                status = 226
+
             size = os.fstat(f.fileno()).st_size
 
             mime_type = "text/plain"
@@ -157,7 +187,9 @@ class HTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             elif filename.endswith(".html"):
                 mime_type = "text/html"
 
-            self.send_response(200)
+            self.send_response(status)
+            if status == 226:
+                self.send_header("IM", "feed")
 
             if encoding:
                 self.send_header("Content-Encoding", encoding)
@@ -173,7 +205,10 @@ class HTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
             self.send_header("Content-Length", size)
             self.send_header("Content-Type", mime_type)
-            self.send_header("ETag", etag)
+            if use_last_modified:
+                self.send_header("Last-Modified", last_modified)
+            else:
+                self.send_header("ETag", etag)
             self.end_headers()
             return f
 